@@ -0,0 +1,334 @@
+"""
+MedBay backend benchmarks.
+
+Usage (from the backend directory):
+    python benchmark.py import [--runs N]
+    python benchmark.py prompt-tokens [--turns N] [--live]
+    python benchmark.py hospitals [--facilities N] [--queries N] [--dataset PATH]
+    python benchmark.py serialization [--hospitals N] [--iterations N]
+    python benchmark.py replay TRACE_FILE [--speed X] [--conversations N]
+
+`import` measures how long `import main` takes in a fresh interpreter (cold start),
+and lists the slowest modules reported by `python -X importtime`.
+
+`prompt-tokens` replays a scripted general-Q&A conversation and compares billed input
+tokens per turn for the legacy flat prompt (persona + stringified history every turn)
+against the chat-session path (persona as system instruction; the session still resends
+the instruction and full history with each message, so both columns are whole prompts).
+Tokens are estimated offline (~4 chars/token); with --live and GEMINI_API_KEY set it
+reports each response's prompt_token_count and also measures time to first streamed byte.
+
+`hospitals` loads a facilities dataset (synthetic, spread over India, unless --dataset
+is given) into the local hospital index and times nearest-4 lookups.
+
+`serialization` micro-benchmarks the hospital path from tool result to response body:
+the legacy json.dumps -> json.loads -> json.dumps (history) -> stdlib JSONResponse chain
+against passing the dict through and rendering it once with ORJSONResponse.
+
+`replay` runs conversations recorded with TRACE_FILE (see traces.py) through the current
+engine, with every upstream call answered from the recording after its recorded latency
+(scaled by --speed; 0 measures engine time alone). It compares turn latency, LLM calls and
+resulting intents with the recording, so a change can be checked against real traffic.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _fresh_import(module: str, importtime: bool = False) -> subprocess.CompletedProcess:
+    args = [sys.executable]
+    if importtime:
+        args += ["-X", "importtime"]
+    args += ["-c", f"import {module}"]
+    env = dict(os.environ, MEDBAY_WARMUP="0")
+    return subprocess.run(args, cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+
+
+def bench_import(runs: int = 5, top: int = 10):
+    """Times `import main` in fresh subprocesses and prints the heaviest imports."""
+    _fresh_import("main")  # prime the bytecode cache so we measure imports, not compilation
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = _fresh_import("main")
+        timings.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            print(result.stderr)
+            sys.exit("`import main` failed; fix the error above before benchmarking.")
+    print(f"import main: median {statistics.median(timings):.1f} ms, min {min(timings):.1f} ms over {runs} runs "
+          f"(includes ~interpreter startup)")
+
+    # -X importtime lines look like: "import time:   self |  cumulative | module"
+    report = _fresh_import("main", importtime=True).stderr.splitlines()
+    rows = []
+    for line in report:
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    print(f"\nTop {top} cumulative imports (us):")
+    for cumulative, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative:>10}  {name}")
+
+
+SCRIPTED_QUESTIONS = [
+    "What is dengue fever?",
+    "How is it different from malaria?",
+    "What are the warning signs that need a hospital visit?",
+    "How can I protect my children from mosquito bites?",
+    "Is it safe to take paracetamol for the fever?",
+    "How long does recovery usually take?",
+    "Can someone get dengue more than once?",
+    "What should I eat while recovering?",
+]
+SCRIPTED_REPLY = ("**Overview:** Dengue is a viral infection spread by Aedes mosquitoes. "
+                  "**Key Points:** * High fever * Severe headache * Pain behind the eyes * Joint and muscle pain * Rash. "
+                  "**Prevention/Management:** Avoid mosquito bites with nets and repellents, remove standing water, "
+                  "rest, drink plenty of fluids and seek care if symptoms worsen. "
+                  "**Disclaimer:** For medical advice tailored to your specific situation, please consult a healthcare professional.")
+
+
+def _legacy_prompt(persona: str, language: str, history: list, text: str) -> str:
+    # The flat prompt process_message used to build on every turn
+    return f"{persona}\nYour response must be in '{language}'.\n---\nCONVERSATION HISTORY:\n{history}\n---\nUSER'S NEW MESSAGE:\n\"{text}\"\n---\nYOUR RESPONSE:"
+
+
+def bench_prompt_tokens(turns: int = 6, live: bool = False):
+    """Compares per-turn billed input tokens (and, live, time to first byte) of the two prompt styles."""
+    os.environ.setdefault("MEDBAY_WARMUP", "0")
+    sys.path.insert(0, BACKEND_DIR)
+    import main as app_main
+
+    language = "en"
+    persona = app_main.PERSONAS["general_qna"]
+    system_instruction = app_main.persona_instruction(persona, language)
+    questions = (SCRIPTED_QUESTIONS * (turns // len(SCRIPTED_QUESTIONS) + 1))[:turns]
+    count = lambda contents: max(1, len(str(contents)) // 4)
+
+    if live:
+        model = app_main.get_gemini_model()
+        chat = app_main.get_persona_model("benchmark", system_instruction).start_chat()
+
+    history, chat_history = [], []
+    totals = {"legacy": 0, "chat": 0}
+    print(f"{'turn':>4} {'legacy':>8} {'chat':>8}" + ("  legacy TTFB  chat TTFB" if live else ""))
+    for turn, question in enumerate(questions, 1):
+        reply = SCRIPTED_REPLY
+        if live:
+            # Read the billed prompt size from the responses themselves: a chat session resends
+            # the system instruction and the whole history with every message
+            start = time.perf_counter()
+            legacy_response = model.generate_content(_legacy_prompt(persona, language, history, question), stream=True)
+            next(iter(legacy_response))
+            legacy_ttfb = (time.perf_counter() - start) * 1000
+            legacy_response.resolve()
+            start = time.perf_counter()
+            response = chat.send_message(question, stream=True)
+            next(iter(response))
+            chat_ttfb = (time.perf_counter() - start) * 1000
+            response.resolve()
+            legacy_tokens = legacy_response.usage_metadata.prompt_token_count
+            chat_tokens = response.usage_metadata.prompt_token_count
+            reply = response.text
+            line = f"{turn:>4} {legacy_tokens:>8} {chat_tokens:>8}  {legacy_ttfb:>8.0f} ms  {chat_ttfb:>6.0f} ms"
+        else:
+            legacy_tokens = count(_legacy_prompt(persona, language, history, question))
+            # system instruction + full history + new turn, as billed on every send_message
+            chat_tokens = count(system_instruction) + count(" ".join(h["parts"][0] for h in chat_history) + " " + question)
+            line = f"{turn:>4} {legacy_tokens:>8} {chat_tokens:>8}"
+        print(line)
+
+        totals["legacy"] += legacy_tokens
+        totals["chat"] += chat_tokens
+        history += [{"role": "user", "parts": [question]}, {"role": "model", "parts": [reply]}]
+        chat_history += [{"role": "user", "parts": [question]}, {"role": "model", "parts": [reply]}]
+
+    legacy_mean, chat_mean = totals["legacy"] / turns, totals["chat"] / turns
+    print(f"\nmean billed input tokens/turn: legacy {legacy_mean:.0f}, chat {chat_mean:.0f} "
+          f"({chat_mean - legacy_mean:+.0f})")
+    if not live:
+        print("estimates only (~4 chars/token); pass --live for the prompt_token_count Gemini bills")
+
+
+def bench_hospitals(facilities: int = 50000, queries: int = 2000, dataset: str | None = None):
+    """Load time and per-query latency of the local hospital index."""
+    import csv
+    import random
+    import tempfile
+    sys.path.insert(0, BACKEND_DIR)
+    from hospitals import load_hospital_dataset
+
+    rng = random.Random(42)
+    india = lambda: (rng.uniform(8.0, 35.0), rng.uniform(68.0, 97.0))
+    if dataset is None:
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", delete=False) as f:
+            writer = csv.writer(f)
+            writer.writerow(["name", "latitude", "longitude", "address"])
+            for i in range(facilities):
+                lat, lng = india()
+                writer.writerow([f"Hospital {i}", f"{lat:.6f}", f"{lng:.6f}", f"Address {i}"])
+            dataset = f.name
+
+    start = time.perf_counter()
+    index = load_hospital_dataset(dataset)
+    print(f"loaded {len(index)} facilities in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    timings, hits = [], 0
+    for _ in range(queries):
+        lat, lng = india()
+        start = time.perf_counter()
+        found = index.nearest(lat, lng, n=4, radius_km=10.0)
+        timings.append((time.perf_counter() - start) * 1000)
+        hits += len(found) >= 4
+    timings.sort()
+    print(f"nearest-4 within 10 km: p50 {timings[len(timings) // 2]:.3f} ms, "
+          f"p99 {timings[int(len(timings) * 0.99)]:.3f} ms over {queries} queries "
+          f"({hits} served locally, the rest would fall back to Google Places)")
+
+
+def bench_serialization(hospitals: int = 4, iterations: int = 20000):
+    """Per-request cost of serializing the hospital payload, legacy chain vs edge-only orjson."""
+    import json
+    import timeit
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse, ORJSONResponse
+    sys.path.insert(0, BACKEND_DIR)
+    from main import summarize_hospitals
+
+    payload = {"hospitals": [
+        {"name": f"Government General Hospital {i}", "address": f"{i} Poonamallee High Rd, Park Town, Chennai, Tamil Nadu 600003",
+         "rating": 4.1, "total_ratings": 1200 + i, "distance_km": 1.25 * i}
+        for i in range(hospitals)
+    ]}
+
+    def legacy():
+        tool_result = json.dumps(payload)            # tool returned a JSON string
+        structured = json.loads(tool_result)          # engine parsed it back
+        history_entry = json.dumps(structured)        # and dumped it into history
+        body = {"data": structured, "current_intent": "hospital_finder", "reply": "Here are some hospitals I found:"}
+        return history_entry, JSONResponse(jsonable_encoder(body)).body
+
+    def edge_only():
+        structured = payload                          # tool returns the dict itself
+        history_entry = summarize_hospitals(structured)
+        body = {"data": structured, "current_intent": "hospital_finder", "reply": "Here are some hospitals I found:"}
+        return history_entry, ORJSONResponse(body).body  # the webhook returns the response itself
+
+    results = {}
+    for name, fn in (("legacy", legacy), ("edge-only orjson", edge_only)):
+        results[name] = min(timeit.repeat(fn, number=iterations, repeat=5)) / iterations * 1e6
+        print(f"{name:>17}: {results[name]:.1f} us per request")
+    print(f"saving: {results['legacy'] - results['edge-only orjson']:.1f} us per request "
+          f"({results['legacy'] / results['edge-only orjson']:.1f}x) with {hospitals} hospitals")
+
+
+def _percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+async def _replay_conversations(app_main, conversations: dict, speed: float) -> dict:
+    from traces import Replay, replaying
+    stats = {"turns": 0, "recorded_ms": [], "replayed_ms": [], "recorded_llm": 0, "replayed_llm": 0,
+             "recorded_upstream": 0, "replayed_upstream": 0, "unmatched": 0, "leftover": 0,
+             "intent_mismatches": 0, "recorded_degraded": 0, "replayed_degraded": 0}
+    app_main.recent_replies.clear()
+    for conversation, turns in conversations.items():
+        # Every conversation starts from the state it was recorded in
+        app_main.conversation_state.pop(conversation, None)
+        if turns[0].get("intent_before"):
+            app_main.conversation_state[conversation] = {
+                "current_intent": turns[0]["intent_before"], "history": [], "selected_language": turns[0]["input"]["language"]}
+        for turn in turns:
+            document_id = (turn["input"].get("context") or {}).get("document_id")
+            if document_id:
+                app_main.document_answer_cache.invalidate(document_id)
+
+        for record in turns:
+            start = time.perf_counter()
+            with replaying(Replay(record, speed=speed)) as replay:
+                reply, intent, _ = await app_main.process_message_within_budget(
+                    conversation, record["input"]["text"], record["input"]["language"], record["input"]["context"])
+            stats["turns"] += 1
+            stats["recorded_ms"].append(record["ms"])
+            stats["replayed_ms"].append((time.perf_counter() - start) * 1000)
+            stats["recorded_llm"] += sum(call["name"] == "gemini" for call in record["upstream"])
+            stats["replayed_llm"] += replay.calls["gemini"]
+            stats["recorded_upstream"] += len(record["upstream"])
+            stats["replayed_upstream"] += sum(replay.calls.values())
+            stats["unmatched"] += sum(replay.unmatched.values())
+            stats["leftover"] += replay.leftover
+            stats["intent_mismatches"] += intent != record["intent_after"]
+            stats["recorded_degraded"] += record["degraded"]
+            stats["replayed_degraded"] += reply in app_main.DEGRADED_REPLIES.values()
+    return stats
+
+
+def bench_replay(path: str, speed: float = 1.0, limit: int | None = None):
+    """Replays recorded conversations against the current engine and compares with the recording."""
+    os.environ.setdefault("MEDBAY_WARMUP", "0")
+    os.environ.pop("TRACE_FILE", None)  # don't record the replay itself
+    os.environ.setdefault("GEMINI_API_KEY", "replay")  # models are constructed but never called
+    sys.path.insert(0, BACKEND_DIR)
+    import main as app_main
+    from traces import load_traces
+
+    conversations = load_traces(path)
+    if limit:
+        conversations = dict(list(conversations.items())[:limit])
+    if not conversations:
+        sys.exit(f"no trace records in {path}")
+    app_main.get_gemini_model()  # import the SDK up front so the first turn isn't charged for it
+    stats = asyncio.run(_replay_conversations(app_main, conversations, speed))
+
+    print(f"replayed {stats['turns']} turns from {len(conversations)} conversations (upstream latency x{speed:g})")
+    print(f"{'':>18} {'recorded':>10} {'replayed':>10}")
+    for label, key in (("turn p50 (ms)", 0.5), ("turn p95 (ms)", 0.95)):
+        print(f"{label:>18} {_percentile(stats['recorded_ms'], key):>10.1f} {_percentile(stats['replayed_ms'], key):>10.1f}")
+    print(f"{'LLM calls/turn':>18} {stats['recorded_llm'] / stats['turns']:>10.2f} {stats['replayed_llm'] / stats['turns']:>10.2f}")
+    print(f"{'upstream calls':>18} {stats['recorded_upstream']:>10} {stats['replayed_upstream']:>10}")
+    print(f"{'degraded replies':>18} {stats['recorded_degraded']:>10} {stats['replayed_degraded']:>10}")
+    print(f"\nintent differs from the recording on {stats['intent_mismatches']} turns; "
+          f"{stats['unmatched']} upstream calls had no recording, {stats['leftover']} recorded calls were not made")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MedBay backend benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_import = sub.add_parser("import", help="cold-start import time of main.py")
+    p_import.add_argument("--runs", type=int, default=5)
+    p_tokens = sub.add_parser("prompt-tokens", help="billed input tokens per chat turn, legacy prompt vs chat session")
+    p_tokens.add_argument("--turns", type=int, default=6)
+    p_tokens.add_argument("--live", action="store_true", help="use the Gemini API (needs GEMINI_API_KEY)")
+    p_hospitals = sub.add_parser("hospitals", help="local hospital index lookup latency")
+    p_hospitals.add_argument("--facilities", type=int, default=50000)
+    p_hospitals.add_argument("--queries", type=int, default=2000)
+    p_hospitals.add_argument("--dataset", help="CSV/GeoJSON to load instead of a synthetic dataset")
+    p_serialization = sub.add_parser("serialization", help="hospital payload serialization cost per request")
+    p_serialization.add_argument("--hospitals", type=int, default=4)
+    p_serialization.add_argument("--iterations", type=int, default=20000)
+    p_replay = sub.add_parser("replay", help="replay recorded conversation traces against the current engine")
+    p_replay.add_argument("trace_file")
+    p_replay.add_argument("--speed", type=float, default=1.0, help="scale recorded upstream latency (0 = no waiting)")
+    p_replay.add_argument("--conversations", type=int, help="only replay the first N conversations")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        bench_import(args.runs)
+    elif args.command == "prompt-tokens":
+        bench_prompt_tokens(args.turns, args.live)
+    elif args.command == "hospitals":
+        bench_hospitals(args.facilities, args.queries, args.dataset)
+    elif args.command == "serialization":
+        bench_serialization(args.hospitals, args.iterations)
+    elif args.command == "replay":
+        bench_replay(args.trace_file, args.speed, args.conversations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import threading
+
+# --- LAZY CLIENT REGISTRY ---
+# Heavy SDKs (supabase, google.generativeai) are imported and configured on first use
+# instead of at import time, so the app starts fast and a missing env var only fails
+# the request that actually needs that client.
+
+GEMINI_MODEL_NAME = "gemini-2.5-flash"
+SAFETY_SETTINGS = [{"category": c, "threshold": "BLOCK_MEDIUM_AND_ABOVE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]]
+
+_clients = {}
+_lock = threading.Lock()  # guards _locks and reset_clients(); never held while a client is built
+_locks = {}  # name -> lock held while that one client is created
+
+
+class ClientConfigError(RuntimeError):
+    """Raised when a client is requested but its environment variables are missing."""
+
+
+def _get_or_create(name: str, factory):
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    # One lock per client, so a factory may build other clients (get_persona_model needs the
+    # base model) and a slow SDK import doesn't hold up callers of unrelated clients.
+    with _lock:
+        lock = _locks.setdefault(name, threading.Lock())
+    with lock:
+        client = _clients.get(name)
+        if client is None:
+            client = factory()
+            _clients[name] = client
+    return client
+
+
+def _create_supabase():
+    url = os.environ.get("SUPABASE_URL")
+    key = os.environ.get("SUPABASE_KEY")
+    if not url or not key:
+        raise ClientConfigError("SUPABASE_URL and SUPABASE_KEY must be set.")
+    from supabase import create_client
+    return create_client(url, key)
+
+
+def _create_gemini_model():
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        raise ClientConfigError("GEMINI_API_KEY must be set.")
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(GEMINI_MODEL_NAME, safety_settings=SAFETY_SETTINGS)
+
+
+def get_supabase():
+    """Returns the shared Supabase client, creating it on first use."""
+    return _get_or_create("supabase", _create_supabase)
+
+
+def get_supabase_admin():
+    """Service-role Supabase client for background jobs, which must see every user's rows.
+    Falls back to the regular client when SUPABASE_SERVICE_ROLE_KEY isn't set."""
+    key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+    if not key:
+        return get_supabase()
+    def create():
+        url = os.environ.get("SUPABASE_URL")
+        if not url:
+            raise ClientConfigError("SUPABASE_URL must be set.")
+        from supabase import create_client
+        return create_client(url, key)
+    return _get_or_create("supabase_admin", create)
+
+
+def get_gemini_model():
+    """Returns the shared Gemini model, configuring the SDK on first use."""
+    return _get_or_create("gemini_model", _create_gemini_model)
+
+
+def get_persona_model(name: str, system_instruction: str):
+    """Returns a Gemini model with `system_instruction` baked in, cached under `name`.
+    The persona then travels as a system instruction (a stable, implicitly cacheable
+    prefix) instead of being pasted into every prompt."""
+    def create():
+        get_gemini_model()  # configures the SDK (and validates the API key) once
+        import google.generativeai as genai
+        return genai.GenerativeModel(GEMINI_MODEL_NAME, safety_settings=SAFETY_SETTINGS, system_instruction=system_instruction)
+    return _get_or_create(f"persona:{name}", create)
+
+
+def _create_http_client():
+    import httpx
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0)
+    return httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(30.0, connect=5.0))
+
+
+def get_http_client():
+    """Returns the shared, connection-pooled httpx.AsyncClient used for upstream services."""
+    return _get_or_create("http", _create_http_client)
+
+
+async def close_clients():
+    """Closes clients that hold open connections. Called on app shutdown."""
+    http_client = _clients.pop("http", None)
+    if http_client is not None:
+        await http_client.aclose()
+
+
+def warm_up() -> dict:
+    """Eagerly creates every client so the first real request doesn't pay for it.
+    Returns a {client_name: "ok" | error message} summary; never raises."""
+    summary = {}
+    for name, getter in (("supabase", get_supabase), ("gemini_model", get_gemini_model)):
+        try:
+            getter()
+            summary[name] = "ok"
+        except Exception as e:
+            summary[name] = str(e)
+    return summary
+
+
+def reset_clients():
+    """Drops all cached clients (used by benchmarks and after credential changes)."""
+    with _lock:
+        _clients.clear()
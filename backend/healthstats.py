@@ -0,0 +1,210 @@
+import asyncio
+import gzip
+import hashlib
+import logging
+import math
+import os
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+import orjson
+
+from clients import get_supabase
+from resilience import call_upstream
+
+logger = logging.getLogger("medbay.healthstats")
+
+# --- HEALTH STATISTICS SNAPSHOT ---
+# The dashboard used to query `who_health_statistics` three times per view and then
+# filter and average the rows again in the browser. Instead, the table is read into an
+# in-memory columnar snapshot (a year column, a country column and one float column per
+# metric, with WHO's -1 "no data" as NaN) every HEALTH_STATS_REFRESH_SECONDS. Everything
+# the dashboard shows is computed from it once per refresh and pre-rendered: JSON bytes,
+# a gzip copy and an ETag, so serving a request is a dictionary lookup. numpy is imported
+# when the first snapshot is built, not at startup.
+
+TABLE = "who_health_statistics"
+METRICS = (
+    "life_expectancy_male_years",
+    "life_expectancy_female_years",
+    "maternal_mortality_ratio",
+    "under_5_mortality_rate",
+    "antenatal_care_coverage_percent",
+    "births_by_skilled_personnel_percent",
+    "hiv_prevalence_rate",
+    "tb_incidence_rate",
+    "polio_cases",
+)
+HEALTH_STATS_REFRESH_SECONDS = float(os.environ.get("HEALTH_STATS_REFRESH_SECONDS", 3600))
+PAGE_SIZE = 1000
+
+
+class RenderedPayload(NamedTuple):
+    body: bytes
+    gzipped: bytes
+    etag: str
+
+
+def render(payload: dict) -> RenderedPayload:
+    """The ETag covers the data but not `generated_at`, so a refresh that finds nothing new
+    keeps it and clients keep getting 304s. It is weak because the bytes do change."""
+    body = orjson.dumps(payload)
+    data = orjson.dumps({key: value for key, value in payload.items() if key != "generated_at"})
+    return RenderedPayload(body, gzip.compress(body, compresslevel=6), f'W/"{hashlib.sha1(data).hexdigest()[:20]}"')
+
+
+def _number(value) -> float:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return math.nan
+    return math.nan if value == -1 else value
+
+
+def _clean(values) -> list:
+    """NaN -> None, and whole numbers back to ints, for JSON."""
+    return [None if math.isnan(v) else (int(v) if v.is_integer() else round(v, 2)) for v in values.tolist()]
+
+
+class HealthStatsSnapshot:
+    """Columnar copy of the table plus every aggregate the dashboard needs, pre-rendered."""
+    def __init__(self, rows: list[dict]):
+        import numpy as np
+        self.generated_at = datetime.now(timezone.utc)
+        rows = [row for row in rows if row.get("year") is not None and row.get("country_name")]
+        self.countries = sorted({row["country_name"] for row in rows})
+        country_codes = {name: code for code, name in enumerate(self.countries)}
+        self.year = np.array([int(row["year"]) for row in rows], dtype=np.int32)
+        self.country = np.array([country_codes[row["country_name"]] for row in rows], dtype=np.int32)
+        self.values = np.array([[_number(row.get(metric)) for metric in METRICS] for row in rows], dtype=np.float64).reshape(len(rows), len(METRICS))
+        self.years = sorted(set(self.year.tolist()))
+
+        self.summary = render(self._summary())
+        self.by_country = {name: render(self._country_series(code)) for code, name in enumerate(self.countries)}
+
+    def __len__(self):
+        return len(self.year)
+
+    def _records(self) -> list[dict]:
+        import numpy as np
+        # Newest year first, then by country, like the dashboard's old query
+        order = np.lexsort((self.country, -self.year))
+        columns = [_clean(self.values[order, m]) for m in range(len(METRICS))]
+        years, countries = self.year[order].tolist(), self.country[order].tolist()
+        return [
+            {"year": years[i], "country_name": self.countries[countries[i]], **{metric: columns[m][i] for m, metric in enumerate(METRICS)}}
+            for i in range(len(order))
+        ]
+
+    def _yearly(self) -> dict:
+        """Per-year mean of each metric over the countries that report it."""
+        import numpy as np
+        years, index = np.unique(self.year, return_inverse=True)
+        valid = ~np.isnan(self.values)
+        sums = np.zeros((len(years), len(METRICS)))
+        counts = np.zeros((len(years), len(METRICS)))
+        np.add.at(sums, index, np.where(valid, self.values, 0.0))
+        np.add.at(counts, index, valid)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(counts > 0, sums / counts, np.nan)
+        yearly = {"years": years.tolist(), "countries_reporting": np.bincount(index, minlength=len(years)).tolist()}
+        yearly.update({metric: _clean(means[:, m]) for m, metric in enumerate(METRICS)})
+        return yearly
+
+    def _summary(self) -> dict:
+        return {
+            "generated_at": self.generated_at.isoformat(),
+            "years": self.years,
+            "countries": self.countries,
+            "metrics": list(METRICS),
+            "records": self._records(),
+            "yearly": self._yearly(),
+        }
+
+    def _country_series(self, code: int) -> dict:
+        """One country's trend series (oldest year first) with its latest values and year-on-year change."""
+        import numpy as np
+        rows = np.flatnonzero(self.country == code)
+        rows = rows[np.argsort(self.year[rows])]
+        values = self.values[rows]
+        series = {"country_name": self.countries[code], "years": self.year[rows].tolist()}
+        series.update({metric: _clean(values[:, m]) for m, metric in enumerate(METRICS)})
+        latest, change = {}, {}
+        for m, metric in enumerate(METRICS):
+            known = values[~np.isnan(values[:, m]), m]
+            latest[metric] = _clean(known[-1:])[0] if len(known) else None
+            change[metric] = _clean(known[-1:] - known[-2:-1])[0] if len(known) > 1 else None
+        series.update(latest=latest, change=change)
+        return series
+
+
+async def fetch_health_statistics() -> list[dict]:
+    """Reads the whole table, a page at a time. Raises on upstream errors."""
+    columns = "year, country_name, " + ", ".join(METRICS)
+    rows, start = [], 0
+    while True:
+        def page(start=start):
+            return get_supabase().table(TABLE).select(columns).order("year").order("country_name").range(start, start + PAGE_SIZE - 1).execute().data
+        batch = await call_upstream("supabase", lambda: asyncio.to_thread(page), timeout=30.0)
+        rows.extend(batch)
+        if len(batch) < PAGE_SIZE:
+            return rows
+        start += PAGE_SIZE
+
+
+class HealthStatsStore:
+    """
+    Holds the current snapshot and replaces it every `interval` seconds (run()). The first
+    request before the initial load waits for it; concurrent loads are shared, and a failed
+    refresh keeps serving the previous snapshot.
+    """
+    def __init__(self, interval: float = HEALTH_STATS_REFRESH_SECONDS):
+        self.interval = interval
+        self._snapshot = None
+        self._loading = None
+        self._task = None
+
+    async def get(self) -> HealthStatsSnapshot:
+        if self._snapshot is not None:
+            return self._snapshot
+        return await self.refresh()
+
+    async def _load(self) -> HealthStatsSnapshot:
+        try:
+            rows = await fetch_health_statistics()
+            snapshot = await asyncio.to_thread(HealthStatsSnapshot, rows)
+        except Exception as e:
+            logger.warning("Health statistics refresh failed: %s", e, extra={"event": "health_stats_refresh_error"})
+            raise
+        self._snapshot = snapshot
+        logger.info("Health statistics snapshot: %d rows, %d countries", len(snapshot), len(snapshot.countries), extra={"event": "health_stats_refresh"})
+        return snapshot
+
+    async def refresh(self) -> HealthStatsSnapshot:
+        if self._loading is None or self._loading.done():
+            self._loading = asyncio.ensure_future(self._load())
+        return await asyncio.shield(self._loading)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception:
+                pass  # logged in _load(); keep serving the previous snapshot
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+health_stats = HealthStatsStore()
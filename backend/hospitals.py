@@ -0,0 +1,155 @@
+import csv
+import json
+import logging
+import math
+import os
+import threading
+
+logger = logging.getLogger("medbay.hospitals")
+
+# --- LOCAL HOSPITAL INDEX ---
+# A bundled facilities dataset (CSV or GeoJSON, path in HOSPITALS_DATASET) is loaded once
+# into a lat/lng grid. A nearest-N query only looks at the few grid cells that overlap the
+# search radius and ranks those candidates with a vectorized haversine, so lookups take
+# well under a millisecond and work offline. Google Places is only needed where the local
+# dataset is sparse. numpy is only imported once a dataset is actually loaded.
+#
+# CSV columns: name, latitude (or lat), longitude (or lng/lon), and optionally address,
+# rating, total_ratings. GeoJSON: a FeatureCollection of Point features with the same
+# properties.
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 111.32
+
+
+def haversine_km(lat: float, lng: float, lats, lngs):
+    """Great-circle distance in km from one point to arrays of points (all in degrees)."""
+    import numpy as np
+    lat1, lng1 = math.radians(lat), math.radians(lng)
+    lat2, lng2 = np.radians(lats), np.radians(lngs)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class HospitalIndex:
+    """Grid-bucketed spatial index over a static list of facilities."""
+    def __init__(self, facilities: list[dict], coordinates: list[tuple[float, float]], cell_degrees: float = 0.1):
+        import numpy as np
+        self.facilities = facilities
+        self.cell_degrees = cell_degrees
+        self._lats = np.array([lat for lat, _ in coordinates], dtype=np.float64)
+        self._lngs = np.array([lng for _, lng in coordinates], dtype=np.float64)
+        rows = np.floor(self._lats / cell_degrees).astype(np.int64)
+        cols = np.floor(self._lngs / cell_degrees).astype(np.int64)
+        cells = {}
+        for index, cell in enumerate(zip(rows.tolist(), cols.tolist())):
+            cells.setdefault(cell, []).append(index)
+        self._cells = {cell: np.array(indices, dtype=np.int64) for cell, indices in cells.items()}
+
+    def __len__(self):
+        return len(self.facilities)
+
+    def _candidates(self, lat: float, lng: float, radius_km: float):
+        import numpy as np
+        dlat = radius_km / KM_PER_DEGREE_LAT
+        dlng = radius_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 0.01))
+        row_range = range(math.floor((lat - dlat) / self.cell_degrees), math.floor((lat + dlat) / self.cell_degrees) + 1)
+        col_range = range(math.floor((lng - dlng) / self.cell_degrees), math.floor((lng + dlng) / self.cell_degrees) + 1)
+        found = [self._cells[(row, col)] for row in row_range for col in col_range if (row, col) in self._cells]
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def nearest(self, lat: float, lng: float, n: int = 4, radius_km: float = 10.0) -> list[dict]:
+        """Up to `n` facilities within `radius_km`, closest first, each with a distance_km."""
+        import numpy as np
+        candidates = self._candidates(lat, lng, radius_km)
+        if candidates.size == 0:
+            return []
+        distances = haversine_km(lat, lng, self._lats[candidates], self._lngs[candidates])
+        within = distances <= radius_km
+        candidates, distances = candidates[within], distances[within]
+        if candidates.size > n:
+            closest = np.argpartition(distances, n)[:n]
+            candidates, distances = candidates[closest], distances[closest]
+        order = np.argsort(distances)
+        return [dict(self.facilities[index], distance_km=round(float(distance), 2))
+                for index, distance in zip(candidates[order].tolist(), distances[order].tolist())]
+
+
+def _first(row: dict, *keys):
+    for key in keys:
+        if row.get(key) not in (None, ""):
+            return row[key]
+    return None
+
+
+def _facility(row: dict) -> dict:
+    rating = _first(row, "rating")
+    return {
+        "name": _first(row, "name", "facility_name", "hospital_name"),
+        "address": _first(row, "address", "formatted_address", "vicinity") or "N/A",
+        "rating": float(rating) if rating is not None else "N/A",
+        "total_ratings": int(float(_first(row, "total_ratings", "user_ratings_total") or 0)),
+    }
+
+
+def load_hospital_dataset(path: str) -> HospitalIndex:
+    """Builds a HospitalIndex from a CSV or GeoJSON file. Rows without a name or valid coordinates are skipped."""
+    facilities, coordinates = [], []
+
+    def add(row: dict, lat, lng):
+        try:
+            lat, lng = float(lat), float(lng)
+        except (TypeError, ValueError):
+            return
+        facility = _facility(row)
+        if facility["name"] and -90 <= lat <= 90 and -180 <= lng <= 180:
+            facilities.append(facility)
+            coordinates.append((lat, lng))
+
+    if path.lower().endswith((".geojson", ".json")):
+        with open(path, encoding="utf-8") as f:
+            collection = json.load(f)
+        for feature in collection.get("features", []):
+            geometry = feature.get("geometry") or {}
+            if geometry.get("type") == "Point":
+                lng, lat = geometry["coordinates"][:2]  # GeoJSON order is [lng, lat]
+                add(feature.get("properties") or {}, lat, lng)
+    else:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                row = {key.strip().lower(): value for key, value in row.items() if key}
+                add(row, _first(row, "latitude", "lat"), _first(row, "longitude", "lng", "lon"))
+    return HospitalIndex(facilities, coordinates)
+
+
+def _numpy_available() -> bool:
+    try:
+        import numpy  # noqa: F401
+    except ImportError:  # pragma: no cover - depends on the deployment
+        return False
+    return True
+
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+
+def get_hospital_index() -> HospitalIndex | None:
+    """The process-wide index, loaded on first use; None when no dataset is configured or loadable."""
+    global _index, _index_loaded
+    if _index_loaded:
+        return _index
+    with _index_lock:
+        if not _index_loaded:
+            path = os.environ.get("HOSPITALS_DATASET")
+            if path and not _numpy_available():
+                logger.warning("numpy is not installed; using Google Places only", extra={"event": "hospital_index"})
+            elif path:
+                try:
+                    _index = load_hospital_dataset(path)
+                    logger.info("Loaded %d facilities from %s", len(_index), path, extra={"event": "hospital_index"})
+                except Exception as e:
+                    logger.error("Could not load %s: %s", path, e, extra={"event": "hospital_index"})
+            _index_loaded = True
+    return _index
@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import importlib.util
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from cachetools import TTLCache
+
+logger = logging.getLogger("medbay.imaging")
+
+# --- X-RAY IMAGE NORMALIZATION ---
+# Phone photos of X-rays are often 5-12 MB JPEGs, but the model service downsamples to a
+# small input size anyway. Decoding, converting to grayscale, resizing and re-encoding here
+# cuts bytes on the wire and the service's own decode time. The work is CPU-bound, so it
+# runs in a process pool off the event loop, and results are cached by content hash.
+# Pillow is optional: without it (or with XRAY_PREPROCESS=0) images are sent unchanged.
+
+# Pillow is only imported in the worker processes, keeping it off the API's cold start.
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+XRAY_PREPROCESS = os.environ.get("XRAY_PREPROCESS", "1") != "0"
+XRAY_INPUT_SIZE = int(os.environ.get("XRAY_INPUT_SIZE", 224))  # shorter side, in pixels
+XRAY_JPEG_QUALITY = int(os.environ.get("XRAY_JPEG_QUALITY", 90))
+XRAY_PREPROCESS_WORKERS = int(os.environ.get("XRAY_PREPROCESS_WORKERS", 2))
+
+_normalized_cache = TTLCache(maxsize=int(os.environ.get("XRAY_PREPROCESS_CACHE_SIZE", 256)), ttl=3600)
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def normalize_xray_image(image_data: bytes, size: int = XRAY_INPUT_SIZE, quality: int = XRAY_JPEG_QUALITY) -> bytes:
+    """Decodes an image, converts it to grayscale, shrinks its shorter side to `size`
+    (never upscales) and re-encodes it as JPEG. Runs in a worker process."""
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(image_data)) as image:
+        # For JPEGs, let the decoder downscale by 1/2..1/8 while decoding: much faster on big photos
+        image.draft("L", (size, size))
+        image = ImageOps.exif_transpose(image).convert("L")
+        width, height = image.size
+        scale = size / min(width, height)
+        if scale < 1:
+            image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawn fresh workers: forking a process that already runs the event loop, to_thread
+            # workers and the logging listener thread can deadlock the child.
+            _pool = ProcessPoolExecutor(max_workers=XRAY_PREPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def shutdown_image_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+async def prepare_xray_image(filename: str, image_data: bytes, content_type: str) -> tuple[str, bytes, str]:
+    """Returns the (filename, bytes, content_type) to send to the model service:
+    the normalized JPEG when preprocessing is available, otherwise the original upload."""
+    if not XRAY_PREPROCESS or not PILLOW_AVAILABLE:
+        return filename, image_data, content_type
+    digest = (await asyncio.to_thread(hashlib.sha256, image_data)).hexdigest()
+    normalized = _normalized_cache.get(digest)
+    if normalized is None:
+        try:
+            loop = asyncio.get_running_loop()
+            normalized = await loop.run_in_executor(_get_pool(), normalize_xray_image, image_data)
+        except Exception as e:
+            # Not decodable by Pillow: let the model service decide what to do with it
+            logger.info("X-ray preprocessing skipped for %s: %s", filename, e, extra={"event": "xray_preprocess_skipped"})
+            return filename, image_data, content_type
+        _normalized_cache[digest] = normalized
+    stem = (filename or "xray").rsplit('.', 1)[0]
+    return f"{stem}.jpg", normalized, "image/jpeg"
@@ -0,0 +1,178 @@
+import atexit
+import copy
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import traceback
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+import orjson
+
+# --- STRUCTURED, NON-BLOCKING LOGGING ---
+# Request handlers only drop a record on an in-memory queue; a background thread formats
+# it as one JSON line (with request/user correlation IDs and phone numbers redacted) and
+# does the actual write. If the queue is full the record is dropped, never waited on.
+#
+#   logger.info("Switching intent", extra={"event": "intent_switch", "from_intent": a, "to_intent": b})
+#
+# High-volume events can be sampled with LOG_SAMPLE_RATES="tool_call=0.1,intent_switch=0.5".
+# Warnings and errors are never sampled.
+
+request_id_var: ContextVar[str | None] = ContextVar("medbay_request_id", default=None)
+user_id_var: ContextVar[str | None] = ContextVar("medbay_user_id", default=None)
+
+PHONE_PATTERN = re.compile(r"\+?\d[\d\s-]{7,}\d")
+_RESERVED = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime", "event", "request_id", "user_id", "sample_rate"}
+
+
+def redact(text: str) -> str:
+    """Masks phone numbers (10+ digits), keeping only the last two (e.g. whatsapp:+**********10)."""
+    def mask(match):
+        digits = match.group(0)
+        bare = re.sub(r"\D", "", digits)
+        if len(bare) < 10:  # dates, ages, ratings...
+            return digits
+        prefix = "+" if digits.startswith("+") else ""
+        return prefix + "*" * (len(bare) - 2) + bare[-2:]
+    return PHONE_PATTERN.sub(mask, text)
+
+
+def bind_user(user_id: str | None):
+    """Tags every log record from the current task with this user."""
+    user_id_var.set(user_id)
+
+
+class ContextFilter(logging.Filter):
+    """Runs in the caller: captures correlation IDs and applies sampling before enqueueing."""
+    def __init__(self, sample_rates: dict[str, float]):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            rate = self.sample_rates.get(getattr(record, "event", None), 1.0)
+            if rate < 1.0 and random.random() >= rate:
+                return False
+            record.sample_rate = rate
+        record.request_id = request_id_var.get()
+        record.user_id = user_id_var.get()
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that does the minimum in the caller and drops records when the queue is full."""
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; runs on the listener thread."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", None),
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "user_id": getattr(record, "user_id", None),
+        }
+        if getattr(record, "sample_rate", 1.0) < 1.0:
+            entry["sample_rate"] = record.sample_rate
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = "".join(traceback.format_exception(*record.exc_info))
+        line = orjson.dumps({k: v for k, v in entry.items() if v is not None}, default=str).decode()
+        return redact(line)
+
+
+def _parse_sample_rates(spec: str) -> dict[str, float]:
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        try:
+            rates[name.strip()] = max(0.0, min(1.0, float(value)))
+        except ValueError:
+            continue
+    return rates
+
+
+_listener = None
+_queue_handler = None
+_setup_lock = threading.Lock()
+
+
+def configure_logging(level: str | None = None) -> logging.Logger:
+    """Routes the 'medbay' logger through the queue. Idempotent; returns the 'medbay' logger."""
+    global _listener, _queue_handler
+    logger = logging.getLogger("medbay")
+    with _setup_lock:
+        if _listener is not None:
+            return logger
+        log_queue = queue.Queue(maxsize=int(os.environ.get("LOG_QUEUE_SIZE", 10000)))
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JsonFormatter())
+        _queue_handler = NonBlockingQueueHandler(log_queue)
+        _queue_handler.addFilter(ContextFilter(_parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", ""))))
+        logger.addHandler(_queue_handler)
+        logger.setLevel(level or os.environ.get("LOG_LEVEL", "INFO"))
+        logger.propagate = False
+        _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+    return logger
+
+
+def shutdown_logging():
+    """Flushes queued records and stops the background writer."""
+    global _listener, _queue_handler
+    with _setup_lock:
+        if _listener is not None:
+            logging.getLogger("medbay").removeHandler(_queue_handler)
+            _listener.stop()
+            _listener, _queue_handler = None, None
+
+
+class CorrelationIdMiddleware:
+    """Pure ASGI middleware: gives every HTTP request an ID (or reuses X-Request-ID) for its logs."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex[:16]
+        request_id_var.set(request_id)
+        user_id_var.set(None)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_with_id)
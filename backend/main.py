@@ -1,35 +1,79 @@
 import os
 import re
 import json
+import orjson
 import httpx
-from datetime import datetime
-import google.generativeai as genai
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Form, Response, UploadFile, File
+from fastapi import FastAPI, HTTPException, Form, Response, UploadFile, File, Depends, Header
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from supabase import create_client, Client
-from pydantic import BaseModel, constr
-from twilio.twiml.messaging_response import MessagingResponse
+from pydantic import BaseModel, ValidationError, confloat, constr, conlist
+from typing import Literal
 import uuid
-from fpdf import FPDF
+import hashlib
+import hmac
+from cachetools import TTLCache
+import threading
+
+load_dotenv()  # before the local modules below, which read their settings from the environment at import
+
+from clients import get_supabase, get_gemini_model, get_persona_model, get_http_client, close_clients, warm_up
+from healthstats import HEALTH_STATS_REFRESH_SECONDS, health_stats
+from hospitals import get_hospital_index
+from logs import CorrelationIdMiddleware, bind_user, configure_logging, shutdown_logging
+from imaging import prepare_xray_image, shutdown_image_pool
+from profiler import MAX_PROFILE_SECONDS, ProfilerBusy, profile_for, watch_task
+from reminders import REMINDER_SCHEDULER, reminder_scheduler
+from ratelimit import RATE_LIMITED_MEDIA_REPLIES, RATE_LIMITED_REPLIES, media_limiter, message_limiter
+from traces import close_trace_writer, end_turn, should_trace, start_turn
+from resilience import UpstreamUnavailable, breaker_states, call_upstream, latency_budget, remaining_budget
 
 # --- INITIAL SETUP ---
-load_dotenv()
-app = FastAPI(title="MedBay API", description="Backend API for the MedBay Public Health Chatbot", version="1.0.0")
+logger = configure_logging()
+
+# --- LIFESPAN (LAZY CLIENTS + WARM-UP) ---
+# Clients are created on first use (see clients.py). The warm-up runs in a background
+# thread after the server starts accepting traffic, so it never delays cold start.
+# Set MEDBAY_WARMUP=0 to skip it entirely.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_logging()  # no-op unless a previous shutdown stopped it
+    warmup_task = None
+    if os.environ.get("MEDBAY_WARMUP", "1") != "0":
+        warmup_task = asyncio.create_task(run_warm_up())
+    if REMINDER_SCHEDULER:
+        reminder_scheduler.start()
+    health_stats.start()
+    yield
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
+    await reminder_scheduler.stop()
+    await health_stats.stop()
+    await close_clients()
+    shutdown_image_pool()
+    close_trace_writer()
+    shutdown_logging()
+
+async def run_warm_up() -> dict:
+    summary = await asyncio.to_thread(warm_up)
+    hospital_index = await asyncio.to_thread(get_hospital_index)
+    summary["hospital_index"] = f"{len(hospital_index)} facilities" if hospital_index is not None else "not configured"
+    try:
+        summary["health_stats"] = f"{len(await health_stats.get())} rows"
+    except Exception as e:
+        summary["health_stats"] = f"error: {e}"
+    logger.info("Warm-up finished", extra={"event": "warm_up", "clients": summary})
+    return summary
+
+app = FastAPI(title="MedBay API", description="Backend API for the MedBay Public Health Chatbot", version="1.0.0", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # --- CORS MIDDLEWARE ---
 origins = ["http://localhost", "http://localhost:3000"]
 app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-
-# --- DATABASE & AI CLIENTS SETUP ---
-supabase_url: str = os.environ.get("SUPABASE_URL")
-supabase_key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(supabase_url, supabase_key)
-
-gemini_api_key = os.environ.get("GEMINI_API_KEY")
-genai.configure(api_key=gemini_api_key)
-safety_settings = [{"category": c, "threshold": "BLOCK_MEDIUM_AND_ABOVE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]]
-gemini_model = genai.GenerativeModel('gemini-2.5-flash', safety_settings=safety_settings)
+app.add_middleware(CorrelationIdMiddleware)
 
 # --- PYDANTIC MODELS ---
 class UserCreate(BaseModel):
@@ -50,42 +94,25 @@ class Coordinates(BaseModel):
     latitude: float
     longitude: float
 
+class BatchOperation(BaseModel):
+    id: str | None = None
+    op: Literal["reverse_geocode", "chat", "vaccination_schedules"]
+    params: dict = {}
 
-class PDF(FPDF):
-    def header(self):
-        self.set_font('Arial', 'B', 15)
-        self.cell(0, 10, 'MedBay - AI Chest X-Ray Analysis Report', 0, 1, 'C')
-        self.ln(5)
+class BatchRequest(BaseModel):
+    operations: conlist(BatchOperation, min_length=1, max_length=20)
 
-    def footer(self):
-        self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
-        
-    def chapter_title(self, title):
-        self.set_font('Arial', 'B', 12)
-        self.cell(0, 10, title, 0, 1, 'L')
-        self.ln(2)
-
-    def chapter_body(self, body):
-        self.set_font('Arial', '', 11)
-        self.multi_cell(0, 5, body)
-        self.ln()
-
-    def analysis_table(self, results):
-        self.set_font('Arial', 'B', 11)
-        self.cell(150, 10, 'Condition Detected', 1, 0, 'C')
-        self.cell(40, 10, 'Probability', 1, 1, 'C')
-        self.set_font('Arial', '', 11)
-        for item in results[:5]: # Top 5 results
-            self.cell(150, 10, item['label'], 1, 0)
-            self.cell(40, 10, f"{item['probability'] * 100:.1f}%", 1, 1, 'C')
-        self.ln()
-
-
-
-def generate_and_upload_pdf_report(filename: str, report_text: str, analysis_results: list) -> str:
-    """Generates a PDF report, uploads it to Supabase, and returns the public URL."""
+class ProfileRequest(BaseModel):
+    seconds: confloat(gt=0, le=MAX_PROFILE_SECONDS) = 10
+    interval_ms: confloat(ge=1, le=1000) = 10
+    user_id: str | None = None
+    intent: str | None = None
+
+
+def generate_and_upload_pdf_report(filename: str, report_text: str, analysis_results: list, per_image_results: list | None = None) -> str:
+    """Generates a PDF report, uploads it to Supabase, and returns the public URL.
+    For a multi-image study, pass per_image_results as [(filename, results), ...] to get one table per image."""
+    from reports import PDF  # fpdf is only imported once a report is actually generated
     pdf = PDF()
     pdf.add_page()
     
@@ -106,8 +133,13 @@ def generate_and_upload_pdf_report(filename: str, report_text: str, analysis_res
         else:
             i += 1
 
-    pdf.chapter_title("Detailed Analysis Results")
-    pdf.analysis_table(analysis_results)
+    if per_image_results:
+        for image_name, image_results in per_image_results:
+            pdf.chapter_title(f"Detailed Analysis Results - {image_name}")
+            pdf.analysis_table(image_results)
+    else:
+        pdf.chapter_title("Detailed Analysis Results")
+        pdf.analysis_table(analysis_results)
     
     # --- THIS IS THE FIX ---
     # pdf.output() with dest='S' already returns bytes, so no .encode() is needed.
@@ -119,15 +151,16 @@ def generate_and_upload_pdf_report(filename: str, report_text: str, analysis_res
     file_path = f"xray_reports/{uuid.uuid4()}_{safe_filename}.pdf"
 
     try:
+        storage = get_supabase().storage.from_('medbay-reports')
         # The supabase client expects bytes directly
-        supabase.storage.from_('medbay-reports').upload(
+        storage.upload(
             file=pdf_bytes,
             path=file_path,
             file_options={"content-type": "application/pdf"}
         )
-        return supabase.storage.from_('medbay-reports').get_public_url(file_path)
+        return storage.get_public_url(file_path)
     except Exception as e:
-        print(f"Error uploading PDF to Supabase: {e}")
+        logger.error("Error uploading PDF to Supabase: %s", e, extra={"event": "pdf_upload_error"})
         return None
 
 
@@ -170,57 +203,86 @@ MENU_OPTIONS = {
 }
 
 # --- BOT TOOLS (Functions the AI can use) ---
-def find_hospitals_data(location_query: str) -> str:
-    """Finds real hospitals using Google Places API."""
-    print(f"TOOL: Searching for real hospitals with query: {location_query}")
+# Tools return plain Python objects; serialization only happens at the edges
+# (the HTTP response, or a prompt that embeds the data).
+HOSPITAL_SEARCH_RADIUS_KM = float(os.environ.get("HOSPITAL_SEARCH_RADIUS_KM", 10))
+HOSPITAL_RESULTS_LIMIT = int(os.environ.get("HOSPITAL_RESULTS_LIMIT", 4))  # hospitals shown, local or from Google
+HOSPITAL_LOCAL_MIN_RESULTS = int(os.environ.get("HOSPITAL_LOCAL_MIN_RESULTS", 2))  # fewer local hits than this -> ask Google
+
+def find_local_hospitals(coords: str) -> list | None:
+    """Nearest hospitals from the bundled dataset, or None if local coverage is too sparse here."""
+    hospital_index = get_hospital_index()
+    if hospital_index is None:
+        return None
+    try:
+        lat, lng = (float(part) for part in coords.split(','))
+    except ValueError:
+        return None
+    hospitals = hospital_index.nearest(lat, lng, n=HOSPITAL_RESULTS_LIMIT, radius_km=HOSPITAL_SEARCH_RADIUS_KM)
+    return hospitals if len(hospitals) >= HOSPITAL_LOCAL_MIN_RESULTS else None
+
+async def find_hospitals_data(location_query: str) -> dict:
+    """Finds real hospitals: the local dataset first for coordinates, then Google Places API."""
+    logger.info("Searching for hospitals", extra={"event": "tool_call", "tool": "find_hospitals", "argument": location_query})
+    is_coords = "user_location::" in location_query
+    if is_coords:
+        # In a thread because the very first lookup may still be loading the dataset
+        local_hospitals = await asyncio.to_thread(find_local_hospitals, location_query.split('::')[1])
+        if local_hospitals:
+            return {"hospitals": local_hospitals}
     api_key = os.environ.get("GOOGLE_PLACES_API_KEY")
     if not api_key:
-        return json.dumps({"error": "Google Places API key is not configured."})
-    is_coords = "user_location::" in location_query
+        return {"error": "Google Places API key is not configured."}
     if is_coords:
         coords = location_query.split('::')[1]
         url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-        params = {"location": coords, "radius": 10000, "type": "hospital", "key": api_key, "region": "IN"}
+        params = {"location": coords, "radius": int(HOSPITAL_SEARCH_RADIUS_KM * 1000), "type": "hospital", "key": api_key, "region": "IN"}
     else:
         url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
         params = {"query": f"hospitals near {location_query}", "key": api_key, "region": "IN"}
     try:
-        with httpx.Client() as client:
-            response = client.get(url, params=params)
-            response.raise_for_status()
-            data = response.json()
+        response = await call_upstream("google_places", lambda: get_http_client().get(url, params=params), timeout=10.0, hedge_after=PLACES_HEDGE_SECONDS)
+        response.raise_for_status()
+        data = response.json()
         if data.get("status") == "OK" and data.get("results"):
             hospitals = []
-            for place in data["results"][:4]:
+            for place in data["results"][:HOSPITAL_RESULTS_LIMIT]:
                 hospitals.append({
                     "name": place.get("name"), "address": place.get("vicinity") or place.get("formatted_address", "N/A"),
                     "rating": place.get("rating", "N/A"), "total_ratings": place.get("user_ratings_total", 0)
                 })
-            return json.dumps({"hospitals": hospitals})
+            return {"hospitals": hospitals}
         else:
-            return json.dumps({"hospitals": [], "message": f"Sorry, I couldn't find any hospitals for that location."})
+            return {"hospitals": [], "message": f"Sorry, I couldn't find any hospitals for that location."}
+    except UpstreamUnavailable as e:
+        logger.warning("Hospital search degraded: %s", e, extra={"event": "degraded", "tool": "find_hospitals"})
+        return {"hospitals": [], "message": "Hospital search is slow right now. Please try again in a minute."}
     except Exception as e:
-        print(f"An unexpected error in find_hospitals_data: {e}")
-        return json.dumps({"error": "An unexpected error occurred."})
-
-def get_vaccination_schedule_data(age_in_weeks: int) -> str:
-    """Fetches vaccination data from the Supabase database for a given age."""
-    print(f"TOOL: Getting vaccination schedule for age: {age_in_weeks} weeks")
-    try:
-        data, count = supabase.table('vaccination_schedules').select('vaccine_name, description').lte('age_due_in_weeks', age_in_weeks).order('age_due_in_weeks', desc=True).limit(5).execute()
-        if count and len(data[1]) > 0:
-            return json.dumps(data[1])
-        return json.dumps([{"message": "No vaccination information found for that specific age."}])
-    except Exception as e:
-        print(f"Database error in get_vaccination_schedule_data: {e}")
-        return json.dumps([{"error": "Could not fetch vaccination data."}])
-
-def get_outbreak_alerts_data(location: str) -> str:
+        logger.exception("Unexpected error in find_hospitals_data", extra={"event": "tool_error", "tool": "find_hospitals"})
+        return {"error": "An unexpected error occurred."}
+
+def get_vaccination_schedule_data(age_in_weeks: int) -> list:
+    """Fetches vaccination data from the Supabase database for a given age.
+    Raises on database errors, so call_upstream's breaker sees them; the caller falls back."""
+    logger.info("Getting vaccination schedule", extra={"event": "tool_call", "tool": "get_vaccination_schedule", "age_in_weeks": age_in_weeks})
+    data, count = get_supabase().table('vaccination_schedules').select('vaccine_name, description').lte('age_due_in_weeks', age_in_weeks).order('age_due_in_weeks', desc=True).limit(5).execute()
+    if count and len(data[1]) > 0:
+        return data[1]
+    return [{"message": "No vaccination information found for that specific age."}]
+
+def get_outbreak_alerts_data(location: str) -> dict:
     """Checks for public health outbreak alerts. (MOCK IMPLEMENTATION)"""
-    print(f"TOOL: Checking for outbreaks near: {location}")
+    logger.info("Checking for outbreaks", extra={"event": "tool_call", "tool": "get_outbreak_alerts", "argument": location})
     if "chennai" in location.lower():
-        return json.dumps({"alert": "Dengue Fever advisory issued for Chennai. Please take precautions."})
-    return json.dumps({"alert": "No major outbreak alerts for your location."})
+        return {"alert": "Dengue Fever advisory issued for Chennai. Please take precautions."}
+    return {"alert": "No major outbreak alerts for your location."}
+
+def summarize_hospitals(payload: dict) -> str:
+    """Short history note for a hospital search, instead of the whole payload."""
+    hospitals = payload.get("hospitals") or []
+    if not hospitals:
+        return payload.get("message") or payload.get("error") or "No hospitals found."
+    return "Hospitals found: " + "; ".join(f"{h['name']} ({h['address']})" for h in hospitals)
 
 # --- PERSONA PROMPTS (UPDATED) ---
 PERSONAS = {
@@ -342,6 +404,91 @@ RULES:
 4.  **Be concise and user-friendly.** Add a concluding sentence advising the user to consult a doctor.
 """
 
+# --- UPSTREAM BUDGETS & DEGRADED MODE ---
+# Every handler runs inside a latency budget; upstream calls go through call_upstream
+# (resilience.py), which caps them to the remaining budget and fails fast via a
+# per-upstream circuit breaker. When we can't answer in time, we reply from the cache of
+# recent answers or with a short localized template instead of hanging the request.
+WEB_BUDGET_SECONDS = float(os.environ.get("WEB_BUDGET_SECONDS", 25))
+TWILIO_BUDGET_SECONDS = float(os.environ.get("TWILIO_BUDGET_SECONDS", 12))  # Twilio gives up on webhooks after 15 s
+GEMINI_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_TIMEOUT_SECONDS", 30))
+PLACES_HEDGE_SECONDS = float(os.environ.get("PLACES_HEDGE_SECONDS", 1.5))
+
+# Chat answers depend on the conversation so far, so only answers to the first question
+# of a conversation are cached, and only served to someone else's first question.
+CACHEABLE_INTENTS = {"general_qna", "myth_buster"}
+recent_replies = TTLCache(maxsize=2048, ttl=6 * 3600)
+
+DEGRADED_REPLIES = {
+    "en": "⏳ MedBay is very busy right now and couldn't answer in time. Please try again in a minute. In an emergency, call 108.",
+    "hi": "⏳ MedBay अभी बहुत व्यस्त है और समय पर उत्तर नहीं दे सका। कृपया एक मिनट बाद फिर से प्रयास करें। आपातकाल में 108 पर कॉल करें।",
+    "od": "⏳ MedBay ବର୍ତ୍ତମାନ ବହୁତ ବ୍ୟସ୍ତ ଅଛି ଏବଂ ସମୟରେ ଉତ୍ତର ଦେଇପାରିଲା ନାହିଁ। ଦୟାକରି ଏକ ମିନିଟ୍ ପରେ ପୁଣି ଚେଷ୍ଟା କରନ୍ତୁ। ଜରୁରୀକାଳୀନ ସ୍ଥିତିରେ 108 କୁ କଲ୍ କରନ୍ତୁ।",
+    "ta": "⏳ MedBay இப்போது மிகவும் பரபரப்பாக உள்ளது, நேரத்தில் பதிலளிக்க முடியவில்லை. ஒரு நிமிடம் கழித்து மீண்டும் முயற்சிக்கவும். அவசர நிலையில் 108 ஐ அழைக்கவும்.",
+}
+
+def normalize_question(text: str) -> str:
+    return " ".join(re.sub(r"[?!.,;:]+", " ", text.lower()).split())
+
+def remember_reply(intent: str, language: str, text: str, reply: str):
+    recent_replies[(intent, language, normalize_question(text))] = reply
+
+def degraded_reply(intent: str, language: str, text: str, first_turn: bool = False) -> str:
+    """A cached answer to the same opening question if we have one, otherwise a localized template."""
+    cached = recent_replies.get((intent, language, normalize_question(text))) if first_turn else None
+    return cached or DEGRADED_REPLIES.get(language, DEGRADED_REPLIES["en"])
+
+async def gemini_generate(prompt: str):
+    """All Gemini calls go through here so they share the 'gemini' breaker and the request budget."""
+    model = get_gemini_model()
+    return await call_upstream("gemini", lambda: model.generate_content_async(prompt), timeout=GEMINI_TIMEOUT_SECONDS)
+
+async def gemini_chat_send(chat, text: str):
+    """Sends one turn on a persistent chat session, with the same breaker and budget as gemini_generate."""
+    return await call_upstream("gemini", lambda: chat.send_message_async(text), timeout=GEMINI_TIMEOUT_SECONDS)
+
+def persona_instruction(persona: str, language: str) -> str:
+    return f"{persona}\nYour response must be in '{language}' language."
+
+def get_chat_session(user_session: dict, intent: str, system_instruction: str, history: list | None = None, reference: str | None = None):
+    """
+    Returns the session's Gemini chat for this intent, starting one if the intent, its
+    system instruction or its reference changed. The persona is sent once as the system
+    instruction and each turn only adds the new message, instead of re-sending persona +
+    stringified history. Per-conversation material (`reference`, e.g. an X-ray report)
+    opens the chat history instead, so persona models stay one per persona and language.
+    """
+    instruction_hash = hashlib.sha1(system_instruction.encode("utf-8")).hexdigest()[:16]
+    reference_hash = hashlib.sha1(reference.encode("utf-8")).hexdigest()[:16] if reference else None
+    chat_key = (intent, instruction_hash, reference_hash)
+    chat = user_session.get("chat")
+    if chat is None or user_session.get("chat_key") != chat_key:
+        model = get_persona_model(instruction_hash, system_instruction)
+        opening = [{"role": "user", "parts": [reference]}, {"role": "model", "parts": ["Understood."]}] if reference else []
+        chat = model.start_chat(history=opening + list(history or []))
+        user_session["chat"], user_session["chat_key"] = chat, chat_key
+    return chat
+
+async def process_message_within_budget(user_id: str, text: str, language: str = 'en', context: dict = None, budget: float = WEB_BUDGET_SECONDS) -> tuple:
+    """Runs process_message under a latency budget; returns a degraded reply instead of timing out."""
+    turn = None
+    if should_trace(user_id):
+        turn = start_turn(user_id, text, language, context, conversation_state.get(user_id, {}).get("current_intent"))
+    with latency_budget(budget):
+        try:
+            result = await asyncio.wait_for(process_message(user_id, text, language, context), remaining_budget())
+        except (asyncio.TimeoutError, UpstreamUnavailable) as e:
+            session = conversation_state.get(user_id, {})
+            current_intent = session.get("current_intent", "language_selection")
+            user_language = session.get("selected_language") or language or "en"
+            logger.warning("Degraded reply: %s", str(e) or "budget exceeded", extra={"event": "degraded", "intent": current_intent})
+            result = degraded_reply(current_intent, user_language, text, first_turn=not session.get("history")), current_intent, None
+            if turn is not None:
+                end_turn(turn, current_intent, result[0], degraded=True)
+            return result
+    if turn is not None:
+        end_turn(turn, result[1], result[0])
+    return result
+
 # --- CORE CONVERSATIONAL ENGINE ---
 def get_intent_from_menu(text: str) -> str | None:
     """Parses the user's menu selection."""
@@ -357,7 +504,7 @@ def get_intent_from_menu(text: str) -> str | None:
     if "9" in clean_text: return "health_quiz"
     return None
 
-def check_for_intent_change(text: str, current_intent: str) -> str | None:
+async def check_for_intent_change(text: str, current_intent: str) -> str | None:
     """Uses the LLM to see if the user wants to switch topics."""
     if not text or len(text) < 5:
         return None
@@ -388,7 +535,7 @@ def check_for_intent_change(text: str, current_intent: str) -> str | None:
     Your response MUST be ONLY a valid JSON object like {{"new_intent": "the_new_intent_name"}} or {{"new_intent": "None"}}.
     """
     try:
-        response = gemini_model.generate_content(prompt)
+        response = await gemini_generate(prompt)
         json_match = re.search(r'\{.*\}', response.text, re.DOTALL)
         if not json_match: return None
         decision = json.loads(json_match.group(0))
@@ -405,15 +552,16 @@ def check_for_intent_change(text: str, current_intent: str) -> str | None:
             return new_intent
         return None
     except Exception as e:
-        print(f"INTENT_SWITCH_ERROR: {e}")
+        logger.warning("Intent check failed: %s", e, extra={"event": "intent_check_error"})
         return None
 
 
 
-def process_message(user_id: str, text: str, language: str = 'en', context: dict = None) -> tuple:
+async def process_message(user_id: str, text: str, language: str = 'en', context: dict = None) -> tuple:
     """
     The conversational engine, returns a tuple of (response_text, current_intent, data_payload).
     """
+    bind_user(user_id)
     if user_id not in conversation_state:
         conversation_state[user_id] = {"current_intent": "language_selection", "history": [], "selected_language": None}
     
@@ -421,16 +569,17 @@ def process_message(user_id: str, text: str, language: str = 'en', context: dict
     current_intent = user_session.get("current_intent", "language_selection")
     history = user_session.get("history", [])
     selected_language = user_session.get("selected_language", None)
+    watch_task(user_id, current_intent)
 
     exit_keywords = ["end", "exit", "exit session", "end session", "menu", "start"]
     greeting_keywords = ["hi", "hello", "hey", "menu", "start"]
 
     # --- 1. HANDLE SESSION RESET ---
     if text.lower().strip() in exit_keywords:
-        print(f"SESSION RESET for user {user_id}")
+        logger.info("Session reset", extra={"event": "session_reset"})
         if user_id in conversation_state:
             del conversation_state[user_id]
-        return process_message(user_id, "hello", language, context=None)
+        return await process_message(user_id, "hello", language, context=None)
 
     # --- 2. HANDLE CONTEXT OVERRIDES ---
     active_context_intent = None
@@ -442,12 +591,12 @@ def process_message(user_id: str, text: str, language: str = 'en', context: dict
             user_session["current_intent"] = "xray_followup"
 
     intent_to_check_against = active_context_intent or current_intent
-    new_intent = check_for_intent_change(text, intent_to_check_against)
+    new_intent = await check_for_intent_change(text, intent_to_check_against)
 
     if new_intent and new_intent != intent_to_check_against:
-        print(f"SWITCHING INTENT from {intent_to_check_against} to {new_intent}")
+        logger.info("Switching intent", extra={"event": "intent_switch", "from_intent": intent_to_check_against, "to_intent": new_intent})
         user_session["current_intent"] = new_intent
-        user_session["history"] = []
+        user_session["history"] = history = []
         current_intent = new_intent
         active_context_intent = None
     else:
@@ -455,21 +604,20 @@ def process_message(user_id: str, text: str, language: str = 'en', context: dict
 
     # --- 3. HANDLE FOLLOW-UP CONTEXTS ---
     if active_context_intent == "document_followup":
-        pdf_response = query_pdf_service_sync(user_id, text)
+        # Always the sender's own document: context["document_id"] only marks the mode
+        pdf_response = await query_pdf_service(user_id, text)
         response_text = pdf_response.get("answer", "Sorry, I couldn't get an answer from the document.")
         return response_text, "document_followup", None
 
     if active_context_intent == "xray_followup" and context and "xray_report" in context:
         report_content = context["xray_report"]
-        persona = PERSONAS["xray_followup"]
-        prompt = (f"{persona}\n---\nPROVIDED X-RAY REPORT:\n{report_content}\n---\n"
-                  f"USER'S QUESTION:\n\"{text}\"")
         try:
-            response = gemini_model.generate_content(prompt)
+            chat = get_chat_session(user_session, "xray_followup", PERSONAS["xray_followup"], reference=f"PROVIDED X-RAY REPORT:\n{report_content}")
+            response = await gemini_chat_send(chat, text)
             response_text = response.text.strip()
             return response_text, "xray_followup", None
         except Exception as e:
-            print(f"Error during X-ray follow-up: {e}")
+            logger.error("Error during X-ray follow-up: %s", e, extra={"event": "llm_error", "intent": "xray_followup"})
             return "I'm sorry, I had trouble processing that question about the report.", "xray_followup", None
 
     # --- 4. MENU SELECTION ---
@@ -490,14 +638,16 @@ def process_message(user_id: str, text: str, language: str = 'en', context: dict
             persona = PERSONAS[chosen_intent]
             # Use selected language for the conversation
             user_language = selected_language or "en"
-            prompt = f"{persona}\nYour response must be in '{user_language}' language.\n---\nThe user has selected this topic. Please provide your opening message."
             try:
-                response = gemini_model.generate_content(prompt)
+                # Start a fresh chat for this topic; later turns in section 8 reuse it
+                user_session.pop("chat", None)
+                chat = get_chat_session(user_session, chosen_intent, persona_instruction(persona, user_language))
+                response = await gemini_chat_send(chat, "The user has selected this topic. Please provide your opening message.")
                 response_text = response.text.strip()
                 history.append({'role': 'model', 'parts': [response_text]})
                 return response_text, chosen_intent, None
             except Exception as e:
-                print(f"Error getting opening message: {e}")
+                logger.error("Error getting opening message: %s", e, extra={"event": "llm_error", "intent": chosen_intent})
                 return "I'm sorry, I had trouble starting that topic.", "greeting", None
         else:
             # Show error in selected language
@@ -532,7 +682,7 @@ def process_message(user_id: str, text: str, language: str = 'en', context: dict
             
             quiz_state['current_question_index'] += 1
         else:
-            new_quiz_questions = generate_health_quiz()
+            new_quiz_questions = await generate_health_quiz()
             if not new_quiz_questions:
                 return "I'm sorry, I couldn't create a quiz right now. Please try again later.", "greeting", None
             
@@ -547,14 +697,14 @@ def process_message(user_id: str, text: str, language: str = 'en', context: dict
             persona = PERSONAS['health_quiz']
             prompt = f"{persona}\n---\n The user has just selected this topic. Please provide your opening message."
             try:
-                opening_response = gemini_model.generate_content(prompt)
+                opening_response = await gemini_generate(prompt)
                 response_text += opening_response.text.strip() + "\n\n"
             except Exception:
                 response_text += "Let's test your health awareness!\n\n"
 
         if quiz_state['current_question_index'] >= len(quiz_state['questions']):
             final_score = quiz_state['score']
-            awareness_summary = generate_quiz_summary(
+            awareness_summary = await generate_quiz_summary(
                 score=final_score,
                 questions=quiz_state['questions'],
                 user_answers=quiz_state['user_answers']
@@ -606,10 +756,11 @@ def process_message(user_id: str, text: str, language: str = 'en', context: dict
     # --- 8. DEFAULT HANDLER (General Q&A and Tools) ---
     persona = PERSONAS.get(current_intent, PERSONAS["general_qna"])
     user_language = selected_language or language or "en"
-    prompt = f"{persona}\nYour response must be in '{user_language}'.\n---\nCONVERSATION HISTORY:\n{history}\n---\nUSER'S NEW MESSAGE:\n\"{text}\"\n---\nYOUR RESPONSE:"
 
+    first_turn = not history
     try:
-        response = gemini_model.generate_content(prompt)
+        chat = get_chat_session(user_session, current_intent, persona_instruction(persona, user_language), history)
+        response = await gemini_chat_send(chat, text)
         response_text = response.text.strip()
 
         tool_command = None
@@ -624,13 +775,12 @@ def process_message(user_id: str, text: str, language: str = 'en', context: dict
             argument = tool_command["argument"]
             
             if tool_name == "find_hospitals":
-                hospitals_data = find_hospitals_data(argument)
-                structured_response = json.loads(hospitals_data)
+                structured_response = await find_hospitals_data(argument)
                 history.append({'role': 'user', 'parts': [text]})
-                history.append({'role': 'model', 'parts': [json.dumps(structured_response)]})
+                history.append({'role': 'model', 'parts': [summarize_hospitals(structured_response)]})
                 return "Here are some hospitals I found:", current_intent, structured_response
 
-            tool_result_data = ""
+            tool_result_data = None
             if tool_name == "get_vaccination_schedule":
                 age_argument = str(argument).lower()
                 age_in_weeks = 0
@@ -640,23 +790,30 @@ def process_message(user_id: str, text: str, language: str = 'en', context: dict
                     if "year" in age_argument or (age_val > 1 and "month" not in age_argument and "week" not in age_argument): age_in_weeks = age_val * 52
                     elif "month" in age_argument: age_in_weeks = age_val * 4
                     else: age_in_weeks = age_val
-                tool_result_data = get_vaccination_schedule_data(age_in_weeks)
+                try:
+                    tool_result_data = await call_upstream("supabase", lambda: asyncio.to_thread(get_vaccination_schedule_data, age_in_weeks), timeout=10.0)
+                except Exception as e:
+                    logger.error("Database error in get_vaccination_schedule_data: %s", e, extra={"event": "tool_error", "tool": "get_vaccination_schedule"})
+                    tool_result_data = [{"error": "Could not fetch vaccination data."}]
             elif tool_name == "get_outbreak_alerts":
                 tool_result_data = get_outbreak_alerts_data(argument)
             
             if tool_result_data:
-                formatting_prompt = f"{FORMATTING_PERSONA}\nYou received this data: {tool_result_data}.\nPresent it to the user in '{user_language}'."
-                final_response = gemini_model.generate_content(formatting_prompt)
+                formatting_prompt = f"{FORMATTING_PERSONA}\nYou received this data: {orjson.dumps(tool_result_data).decode()}.\nPresent it to the user in '{user_language}'."
+                final_response = await gemini_generate(formatting_prompt)
                 response_text = final_response.text
         
         history.append({'role': 'user', 'parts': [text]})
         history.append({'role': 'model', 'parts': [response_text]})
+        if first_turn and not tool_command and current_intent in CACHEABLE_INTENTS:
+            remember_reply(current_intent, user_language, text, response_text)
         return response_text, current_intent, None
 
+    except UpstreamUnavailable as e:
+        logger.warning("Degraded reply: %s", e, extra={"event": "degraded", "intent": current_intent})
+        return degraded_reply(current_intent, user_language, text, first_turn), current_intent, None
     except Exception as e:
-        print(f"Error in conversational engine: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in conversational engine", extra={"event": "engine_error", "intent": current_intent})
         return "I'm sorry, I encountered a technical issue. Please try rephrasing.", current_intent, None
 
 
@@ -670,7 +827,7 @@ def process_message(user_id: str, text: str, language: str = 'en', context: dict
 
 # In main.py (place this with your other functions)
 
-def generate_health_quiz() -> list | None:
+async def generate_health_quiz() -> list | None:
     """Uses Gemini to generate a 5-question health quiz and returns it as a list of dicts."""
     prompt = """
     You are an AI assistant that creates educational health quizzes.
@@ -685,24 +842,24 @@ def generate_health_quiz() -> list | None:
     Do not include any text, explanation, or markdown formatting before or after the JSON array. Your entire response must be only the JSON data.
     """
     try:
-        response = gemini_model.generate_content(prompt)
+        response = await gemini_generate(prompt)
         # Clean up the response to extract only the JSON part
         json_match = re.search(r'\[.*\]', response.text, re.DOTALL)
         if json_match:
             quiz_data = json.loads(json_match.group(0))
             # Basic validation to ensure we got 5 questions
             if isinstance(quiz_data, list) and len(quiz_data) == 5:
-                print("Successfully generated new health quiz.")
+                logger.info("Generated new health quiz", extra={"event": "quiz_generated"})
                 return quiz_data
-        print("Failed to parse or validate quiz JSON from LLM.")
+        logger.warning("Failed to parse or validate quiz JSON from LLM", extra={"event": "quiz_invalid"})
         return None
     except Exception as e:
-        print(f"Error generating health quiz from Gemini: {e}")
+        logger.error("Error generating health quiz from Gemini: %s", e, extra={"event": "llm_error", "intent": "health_quiz"})
         return None
 
 # In main.py (place this with your other functions)
 
-def generate_quiz_summary(score: int, questions: list, user_answers: list) -> str:
+async def generate_quiz_summary(score: int, questions: list, user_answers: list) -> str:
     """Uses Gemini to generate a personalized summary of the user's quiz performance."""
     
     # Format the detailed results for the prompt
@@ -723,10 +880,10 @@ def generate_quiz_summary(score: int, questions: list, user_answers: list) -> st
     """
     
     try:
-        response = gemini_model.generate_content(prompt)
+        response = await gemini_generate(prompt)
         return response.text.strip()
     except Exception as e:
-        print(f"Error generating quiz summary: {e}")
+        logger.error("Error generating quiz summary: %s", e, extra={"event": "llm_error", "intent": "health_quiz"})
         # Fallback to a generic summary if the LLM fails
         if score <= 2:
             return "You have a good start! There's a great opportunity to learn more about some key health topics."
@@ -753,43 +910,54 @@ async def process_xray_from_url(image_url: str) -> str:
         async with httpx.AsyncClient(follow_redirects=True) as client:
             
             # 1. Download the image. The client will now handle the 307 redirect automatically.
-            print(f"Downloading image from: {image_url}")
-            image_response = await client.get(image_url, auth=auth, timeout=30.0)
+            logger.info("Downloading WhatsApp image", extra={"event": "media_download"})
+            image_response = await call_upstream("twilio_media", lambda: client.get(image_url, auth=auth, timeout=30.0), timeout=30.0)
             
             image_response.raise_for_status() # This will now check the status of the FINAL URL (which should be 200 OK)
             image_data = image_response.content
             content_type = image_response.headers.get("content-type", "image/jpeg")
 
             # 2. Send the downloaded image to your analysis service
-            xray_service_url = "http://localhost:8001/predict"
-            files = {"file": ("whatsapp_xray.jpg", image_data, content_type)}
-            analysis_response = await client.post(xray_service_url, files=files, timeout=60.0)
-            analysis_response.raise_for_status()
-            xray_results = analysis_response.json()
+            analysis_data = await predict_xray("whatsapp_xray.jpg", image_data, content_type)
             
             # 3. Generate the text-based medical report
-            analysis_data = xray_results.get("results", [])
             if not analysis_data:
                 return "The analysis did not return any findings. Please ensure you sent a clear chest X-ray image."
 
-            text_report = generate_xray_medical_report(analysis_data)
+            text_report = await generate_xray_medical_report(analysis_data)
             return text_report
             
+    except UpstreamUnavailable as e:
+        logger.warning("X-ray from URL degraded: %s", e, extra={"event": "degraded", "upstream": "xray_service"})
+        return "⏳ Our X-ray analysis service is busy right now. Please send the image again in a few minutes."
     except httpx.HTTPStatusError as e:
-        print(f"HTTP Error downloading image: {e.response.status_code}")
+        logger.error("HTTP error downloading image: %s", e.response.status_code, extra={"event": "media_download_error"})
         return "I couldn't access the image from WhatsApp. It might have expired or there's a permission issue. Please try sending it again."
     except Exception as e:
-        print(f"Error processing X-ray from URL: {e}")
+        logger.exception("Error processing X-ray from URL", extra={"event": "xray_error"})
         return "I'm sorry, an error occurred while analyzing the image. Please ensure it's a valid chest X-ray file and try again."
 
 # --- WEBHOOK ENDPOINTS ---
 @app.post("/webhook/web")
-def handle_web_message(web_input: WebMessage):
-    response_text, current_intent, data_payload = process_message(
-        web_input.message.user_id, 
-        web_input.message.text, 
-        web_input.message.language, 
-        web_input.message.context
+async def handle_web_message(web_input: WebMessage):
+    # The reply is plain JSON types already, so render it directly and skip jsonable_encoder
+    return ORJSONResponse(await reply_to_web_message(web_input.message))
+
+def rate_limited_reply(sender: str, replies: dict) -> tuple:
+    """Cheap rejection: no LLM call, just the sender's current intent and a localized note."""
+    session = conversation_state.get(sender, {})
+    language = session.get("selected_language") or "en"
+    return replies.get(language, replies["en"]), session.get("current_intent", "language_selection")
+
+async def reply_to_web_message(message: Message) -> dict:
+    if not message_limiter.allow(message.user_id):
+        reply, current_intent = rate_limited_reply(message.user_id, RATE_LIMITED_REPLIES)
+        return {"reply": reply, "current_intent": current_intent, "rate_limited": True}
+    response_text, current_intent, data_payload = await process_message_within_budget(
+        message.user_id, 
+        message.text, 
+        message.language, 
+        message.context
     )
 
     if data_payload:
@@ -810,13 +978,19 @@ async def handle_twilio_message(
     MediaUrl0: str = Form(None)
 ):
     final_response_text = ""
+    bind_user(From)
     try:
+        is_media = NumMedia > 0 and MediaUrl0
+        limiter, limited_replies = (media_limiter, RATE_LIMITED_MEDIA_REPLIES) if is_media else (message_limiter, RATE_LIMITED_REPLIES)
+        if not limiter.allow(From):
+            final_response_text, _ = rate_limited_reply(From, limited_replies)
         # Check if the incoming message contains an image
-        if NumMedia > 0 and MediaUrl0:
-            final_response_text = await process_xray_from_url(MediaUrl0)
+        elif is_media:
+            with latency_budget(TWILIO_BUDGET_SECONDS):
+                final_response_text = await process_xray_from_url(MediaUrl0)
         else:
             # If no image, process it as a regular text message
-            response_text, current_intent, data_payload = process_message(From, Body, 'en')
+            response_text, current_intent, data_payload = await process_message_within_budget(From, Body, 'en', budget=TWILIO_BUDGET_SECONDS)
             final_response_text = response_text
 
             # Format data payload if it exists (e.g., for hospitals)
@@ -828,25 +1002,37 @@ async def handle_twilio_message(
                 final_response_text += hospital_list_text
     
     except Exception as e:
-        print(f"Error in Twilio webhook: {e}")
+        logger.exception("Error in Twilio webhook", extra={"event": "webhook_error"})
         final_response_text = "I'm sorry, a critical error occurred. Please try again later."
 
     # Create and send the TwiML response for WhatsApp
+    from twilio.twiml.messaging_response import MessagingResponse
     response = MessagingResponse()
     response.message(final_response_text)
     return Response(content=str(response), media_type="application/xml")
 
 
 
+# --- ADMIN AUTH ---
+def require_admin(x_admin_token: str | None = Header(None)):
+    """Admin endpoints exist only when ADMIN_TOKEN is set, and need it in X-Admin-Token."""
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), admin_token.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
 # --- OTHER ENDPOINTS ---
 @app.get("/")
 def read_root(): return {"Project": "MedBay", "Status": "Healthy"}
 @app.get("/health")
-def health_check(): return {"status": "ok"}
+def health_check(): return {"status": "ok", "upstreams": breaker_states(), "reminders": reminder_scheduler.stats()}
+@app.post("/warmup", dependencies=[Depends(require_admin)])
+async def trigger_warm_up(): return {"clients": await run_warm_up()}
 @app.post("/users", status_code=201)
 def create_user(user: UserCreate):
     try:
-        data, count = supabase.table('users').insert(user.dict()).execute()
+        data, count = get_supabase().table('users').insert(user.dict()).execute()
         if count and len(data[1]) > 0: return {"message": "User created successfully", "user": data[1][0]}
         else: raise HTTPException(status_code=400, detail="Could not create user.")
     except Exception as e: raise HTTPException(status_code=400, detail=str(e))
@@ -854,15 +1040,18 @@ def create_user(user: UserCreate):
 @app.get("/users/phone/{phone_number}")
 def get_user_by_phone(phone_number: str):
     try:
-        data, count = supabase.table('users').select('*').eq('phone_number', phone_number).execute()
+        data, count = get_supabase().table('users').select('*').eq('phone_number', phone_number).execute()
         if count and len(data[1]) > 0: return {"user": data[1][0]}
         else: raise HTTPException(status_code=404, detail="User not found.")
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
         
 @app.get("/vaccination-schedules")
-def get_all_vaccination_schedules():
+async def get_all_vaccination_schedules():
+    return await asyncio.to_thread(fetch_all_vaccination_schedules)
+
+def fetch_all_vaccination_schedules():
     try:
-        data, count = supabase.table('vaccination_schedules').select('*').order('age_due_in_weeks').execute()
+        data, count = get_supabase().table('vaccination_schedules').select('*').order('age_due_in_weeks').execute()
         return {"schedules": data[1]}
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
@@ -874,23 +1063,16 @@ async def upload_xray_image(file: UploadFile = File(...)):
     Uploads an X-ray, gets analysis, generates a text and PDF report, 
     and returns URLs and data.
     """
+    watch_task(intent="xray_analysis")
     try:
         if not file.content_type or not file.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="Please upload a valid image file.")
         
         image_data = await file.read()
-        xray_service_url = "http://localhost:8001/predict"
-        
-        async with httpx.AsyncClient() as client:
-            files = {"file": (file.filename, image_data, file.content_type)}
-            response = await client.post(xray_service_url, files=files, timeout=60.0)
-            response.raise_for_status()
-            xray_results = response.json()
+        analysis_data = await predict_xray(file.filename, image_data, file.content_type)
         
-        analysis_data = xray_results.get("results", [])
-        
-        text_report = generate_xray_medical_report(analysis_data)
-        pdf_url = generate_and_upload_pdf_report(file.filename, text_report, analysis_data)
+        text_report = await generate_xray_medical_report(analysis_data)
+        pdf_url = await asyncio.to_thread(generate_and_upload_pdf_report, file.filename, text_report, analysis_data)
         
         return {
             "status": "success",
@@ -900,28 +1082,132 @@ async def upload_xray_image(file: UploadFile = File(...)):
             "pdf_url": pdf_url
         }
         
+    except UpstreamUnavailable as e:
+        raise HTTPException(status_code=503, detail=f"X-ray analysis service is unavailable: {e}")
     except httpx.RequestError as e:
         raise HTTPException(status_code=503, detail=f"X-ray analysis service is unavailable: {e}")
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=502, detail=f"Error from X-ray analysis service: {e.response.text}")
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error processing uploaded X-ray", extra={"event": "xray_error"})
         raise HTTPException(status_code=500, detail="An error occurred while processing the X-ray image.")
 
 
 
 
-def generate_xray_medical_report(results):
+# --- X-RAY STUDY (MULTI-IMAGE) ---
+XRAY_SERVICE_URL = "http://localhost:8001/predict"
+XRAY_MAX_CONCURRENCY = int(os.environ.get("XRAY_MAX_CONCURRENCY", 4))
+XRAY_MAX_STUDY_IMAGES = int(os.environ.get("XRAY_MAX_STUDY_IMAGES", 10))
+
+async def predict_xray(filename: str, image_data: bytes, content_type: str) -> list:
+    """Sends one image to the X-ray model service and returns its results list. Raises httpx/Upstream errors."""
+    files = {"file": await prepare_xray_image(filename, image_data, content_type)}
+    response = await call_upstream("xray_service", lambda: get_http_client().post(XRAY_SERVICE_URL, files=files, timeout=60.0), timeout=60.0)
+    response.raise_for_status()
+    return response.json().get("results", [])
+
+@app.post("/api/xray-upload/batch")
+async def upload_xray_study(files: list[UploadFile] = File(...)):
+    """
+    Analyzes a multi-image study. Predictions fan out to the X-ray service with bounded
+    concurrency and stream back as NDJSON lines as each image completes, followed by one
+    combined report and PDF for the whole study.
+    """
+    if len(files) > XRAY_MAX_STUDY_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Please upload at most {XRAY_MAX_STUDY_IMAGES} images per study.")
+    for file in files:
+        if not file.content_type or not file.content_type.startswith('image/'):
+            raise HTTPException(status_code=400, detail=f"'{file.filename}' is not a valid image file.")
+    # Read everything up front: the upload files are closed once the streaming response starts
+    images = [(file.filename, await file.read(), file.content_type) for file in files]
+    return StreamingResponse(stream_xray_study(images), media_type="application/x-ndjson")
+
+async def stream_xray_study(images: list[tuple]):
+    watch_task(intent="xray_analysis")  # runs in the response-streaming task, not the handler's
+    semaphore = asyncio.Semaphore(XRAY_MAX_CONCURRENCY)
+
+    async def analyze(index: int, filename: str, image_data: bytes, content_type: str):
+        async with semaphore:
+            try:
+                return index, filename, await predict_xray(filename, image_data, content_type), None
+            except (UpstreamUnavailable, httpx.RequestError) as e:
+                return index, filename, None, f"X-ray analysis service is unavailable: {e}"
+            except httpx.HTTPStatusError as e:
+                return index, filename, None, f"Error from X-ray analysis service: {e.response.text}"
+            except Exception:
+                # One bad image (undecodable file, malformed service response) must not end the stream
+                logger.exception("Error analyzing study image %s", filename, extra={"event": "xray_error", "intent": "xray_analysis"})
+                return index, filename, None, "An error occurred while analyzing this image."
+
+    tasks = [asyncio.create_task(analyze(index, *image)) for index, image in enumerate(images)]
+    completed = {}
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, filename, results, error = await next_done
+            line = {"type": "image", "index": index, "filename": filename}
+            if error:
+                line.update(status="error", error=error)
+            else:
+                completed[index] = (filename, results)
+                line.update(status="success", analysis_results=results)
+            yield orjson.dumps(line) + b"\n"
+    finally:
+        for task in tasks:  # the client went away mid-stream
+            task.cancel()
+
+    if not completed:
+        yield orjson.dumps({"type": "study", "status": "error", "error": "None of the images could be analyzed."}) + b"\n"
+        return
+    per_image_results = [completed[index] for index in sorted(completed)]
+    text_report = await generate_xray_study_report(per_image_results)
+    pdf_url = await asyncio.to_thread(generate_and_upload_pdf_report, f"study_{len(per_image_results)}_images", text_report, [], per_image_results)
+    yield orjson.dumps({
+        "type": "study",
+        "status": "success",
+        "images_analyzed": len(per_image_results),
+        "medical_report": text_report,
+        "pdf_url": pdf_url
+    }) + b"\n"
+
+def format_xray_conditions(results: list) -> str:
+    return "\n".join([
+        f"- {result['label']}: {result['probability']:.2%} probability"
+        for result in results[:5]  # Top 5 conditions
+    ])
+
+async def generate_xray_study_report(per_image_results: list) -> str:
+    """Generates one combined medical report for all images of a study."""
+    try:
+        study_text = "\n\n".join(f"Image '{name}':\n{format_xray_conditions(results)}" for name, results in per_image_results)
+        prompt = f"""
+        You are a medical AI assistant analyzing a chest X-ray study made of {len(per_image_results)} images of the same patient. Based on the following per-image analysis results, provide ONE clear, professional medical report for the whole study:
+
+        Analysis Results:
+        {study_text}
+
+        Please provide:
+        1. A brief summary of the findings across all images
+        2. The most significant conditions detected (if any with >30% probability), noting whether they appear consistently across images
+        3. General recommendations for follow-up
+        4. Important disclaimers about the limitations of AI analysis
+
+        Keep the report concise (under 250 words) and use professional medical language while remaining accessible to patients.
+        Always emphasize that this is a preliminary analysis and professional medical consultation is required.
+        """
+        response = await gemini_generate(prompt)
+        return response.text.strip()
+    except Exception as e:
+        logger.error("Error generating study report: %s", e, extra={"event": "llm_error", "intent": "xray_study"})
+        return "Unable to generate detailed report at this time. Please consult with a healthcare professional for proper interpretation of your X-ray results."
+
+async def generate_xray_medical_report(results):
     """
     Generates a medical report based on X-ray analysis results using Gemini AI.
     """
     try:
         # Format the results for the AI
-        conditions_text = "\n".join([
-            f"- {result['label']}: {result['probability']:.2%} probability"
-            for result in results[:5]  # Top 5 conditions
-        ])
+        conditions_text = format_xray_conditions(results)
         
         prompt = f"""
         You are a medical AI assistant analyzing chest X-ray results. Based on the following analysis results, provide a clear, professional medical report:
@@ -939,17 +1225,17 @@ def generate_xray_medical_report(results):
         Always emphasize that this is a preliminary analysis and professional medical consultation is required.
         """
         
-        response = gemini_model.generate_content(prompt)
+        response = await gemini_generate(prompt)
         return response.text.strip()
         
     except Exception as e:
-        print(f"Error generating medical report: {e}")
+        logger.error("Error generating medical report: %s", e, extra={"event": "llm_error", "intent": "xray_report"})
         return "Unable to generate detailed report at this time. Please consult with a healthcare professional for proper interpretation of your X-ray results."
 
 
 
 @app.post("/api/reverse-geocode")
-def reverse_geocode(coords: Coordinates):
+async def reverse_geocode(coords: Coordinates):
     """Converts latitude and longitude into a more specific, human-readable address."""
     api_key = os.environ.get("GOOGLE_PLACES_API_KEY")
     if not api_key:
@@ -957,10 +1243,9 @@ def reverse_geocode(coords: Coordinates):
     url = "https://maps.googleapis.com/maps/api/geocode/json"
     params = {"latlng": f"{coords.latitude},{coords.longitude}", "key": api_key}
     try:
-        with httpx.Client() as client:
-            response = client.get(url, params=params)
-            response.raise_for_status()
-            data = response.json()
+        response = await call_upstream("google_geocode", lambda: get_http_client().get(url, params=params), timeout=10.0, hedge_after=PLACES_HEDGE_SECONDS)
+        response.raise_for_status()
+        data = response.json()
         if data["status"] == "OK" and data["results"]:
             first_result = data["results"][0]
             locality, sublocality, state = "", "", ""
@@ -974,37 +1259,130 @@ def reverse_geocode(coords: Coordinates):
             return {"displayName": display_name}
         else:
             error_message = data.get("error_message", "No results found.")
-            print(f"GOOGLE GEOCODE API ERROR: Status was '{data.get('status')}'. Message: {error_message}")
+            logger.warning("Google Geocode API returned %s: %s", data.get('status'), error_message, extra={"event": "geocode_error"})
             return {"displayName": "Unknown Location"}
     except Exception as e:
-        print(f"Error in reverse_geocode: {e}")
+        logger.error("Error in reverse_geocode: %s", e, extra={"event": "geocode_error"})
         raise HTTPException(status_code=500, detail="Error contacting geocoding service.")
 
 
+# --- BATCH ENDPOINT ---
+async def run_batch_operation(operation: BatchOperation) -> dict:
+    """Runs one batch operation and wraps its outcome; never raises."""
+    result = {"id": operation.id, "op": operation.op}
+    try:
+        if operation.op == "reverse_geocode":
+            data = await reverse_geocode(Coordinates(**operation.params))
+        elif operation.op == "chat":
+            data = await reply_to_web_message(Message(**operation.params))
+        else:
+            data = await get_all_vaccination_schedules()
+        result.update(status="ok", data=data)
+    except ValidationError as e:
+        result.update(status="error", error={"status_code": 422, "detail": e.errors(include_url=False)})
+    except HTTPException as e:
+        result.update(status="error", error={"status_code": e.status_code, "detail": e.detail})
+    except Exception as e:
+        logger.exception("Error in batch operation %s", operation.op, extra={"event": "batch_error"})
+        result.update(status="error", error={"status_code": 500, "detail": "An unexpected error occurred."})
+    return result
+
+async def run_operations_in_order(operations: list[BatchOperation]) -> list[dict]:
+    return [await run_batch_operation(op) for op in operations]
+
+@app.post("/api/batch")
+async def run_batch(batch: BatchRequest):
+    """
+    Runs several operations in one round trip. Independent operations run concurrently;
+    chat messages for the same user_id run sequentially, in request order, because they
+    share conversation state. Results come back in request order with per-operation errors.
+    """
+    operations = batch.operations
+    groups = {}  # group key -> request indices that must run in order
+    for index, operation in enumerate(operations):
+        key = ("chat", str(operation.params.get("user_id"))) if operation.op == "chat" else ("op", index)
+        groups.setdefault(key, []).append(index)
+
+    group_indices = list(groups.values())
+    outcomes = await asyncio.gather(*(run_operations_in_order([operations[i] for i in indices]) for indices in group_indices))
+    results = [None] * len(operations)
+    for indices, group_results in zip(group_indices, outcomes):
+        for index, result in zip(indices, group_results):
+            results[index] = result
+    return {"results": results}
+
+
+# --- ADMIN: ON-DEMAND PROFILING ---
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def run_profiler(request: ProfileRequest):
+    """
+    Samples conversation turns and uploads for `seconds` (optionally only those of one
+    user_id and/or intent) and returns a folded-stacks profile for flamegraph.pl/speedscope.
+    Blocks for the whole window; one session at a time.
+    """
+    try:
+        session = await profile_for(request.seconds, request.interval_ms / 1000, request.user_id, request.intent)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    logger.info("Profile captured", extra={"event": "profile", "samples": session.samples, "stacks": len(session.stacks)})
+    return Response(session.folded(), media_type="text/plain", headers={"X-Profile-Samples": str(session.samples)})
+
+
+# --- HEALTH STATISTICS (DASHBOARD) ---
+@app.get("/api/health-stats")
+async def get_health_stats(country: str | None = None, if_none_match: str | None = Header(None), accept_encoding: str | None = Header(None)):
+    """
+    Everything the dashboard shows in one response: the WHO records plus per-year means, or
+    with ?country= that country's trend series. Served from the precomputed snapshot in
+    healthstats.py, gzipped when the client accepts it, with an ETag for conditional requests.
+    """
+    try:
+        snapshot = await health_stats.get()
+    except Exception:
+        raise HTTPException(status_code=503, detail="Health statistics are unavailable right now.")
+    payload = snapshot.summary if country is None else snapshot.by_country.get(country)
+    if payload is None:
+        raise HTTPException(status_code=404, detail=f"No health statistics for '{country}'.")
+
+    headers = {
+        "ETag": payload.etag,
+        "Cache-Control": f"public, max-age={int(HEALTH_STATS_REFRESH_SECONDS)}, stale-while-revalidate={int(HEALTH_STATS_REFRESH_SECONDS)}",
+        "Vary": "Accept-Encoding",
+    }
+    if if_none_match and payload.etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    if accept_encoding and "gzip" in accept_encoding.lower():
+        return Response(payload.gzipped, media_type="application/json", headers=dict(headers, **{"Content-Encoding": "gzip"}))
+    return Response(payload.body, media_type="application/json", headers=headers)
+
+
 
 @app.post("/api/document/upload/")
-async def forward_document_upload(user_id: str = Form(...), file: UploadFile = File(...)):
+async def forward_document_upload(user_id: str = Form(...), file: UploadFile = File(...), reprocess: bool = Form(False)):
     """
-    Forwards the PDF and user_id to the separate PDF analysis service.
+    Forwards the PDF to the separate PDF analysis service, unless the same file was already
+    processed, in which case the user is linked to the existing document (see DocumentIndex).
+    Pass reprocess=true to force a fresh parse. The response looks the same either way, so
+    it doesn't tell the caller whether someone else already uploaded this file.
     """
-    pdf_service_url = "http://localhost:8002/upload-pdf/" # URL of your PDF microservice
-    
+    watch_task(user_id, "document_analysis")
     if file.content_type != 'application/pdf':
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a PDF.")
     
     file_data = await file.read()
-    
-    # Prepare the data and file for forwarding
-    files = {'file': (file.filename, file_data, file.content_type)}
-    data = {'user_id': user_id}
+    digest = (await asyncio.to_thread(hashlib.sha256, file_data)).hexdigest()
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(pdf_service_url, files=files, data=data, timeout=60.0)
-            response.raise_for_status() # Raise an exception for 4xx or 5xx status codes
-            return response.json()
-            
-    except httpx.RequestError:
+        known = None if reprocess else document_index.lookup(digest)
+        if known is not None:
+            logger.info("Linked duplicate document upload", extra={"event": "document_dedup", "document_id": known["document_id"]})
+            result = dict(known, filename=file.filename) if "filename" in known else known
+        else:
+            result = await ingest_document(digest, file.filename, file_data, file.content_type)
+        await link_user_document(user_id, result["document_id"])
+        return result
+
+    except (httpx.RequestError, UpstreamUnavailable):
         raise HTTPException(status_code=503, detail="PDF analysis service is unavailable.")
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=502, detail=f"Error from PDF analysis service: {e.response.text}")
@@ -1015,36 +1393,187 @@ async def forward_document_upload(user_id: str = Form(...), file: UploadFile = F
 @app.post("/api/document/query")
 async def forward_document_query(user_id: str = Form(...), question: str = Form(...)):
     """
-    Forwards the user's question to the separate PDF analysis service.
+    Forwards the user's question about their current document to the separate PDF analysis service.
     """
-    pdf_service_url = "http://localhost:8002/chat/" # URL of your PDF microservice
-    data = {'user_id': user_id, 'question': question}
-
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(pdf_service_url, data=data, timeout=30.0)
-            response.raise_for_status()
-            return response.json()
-            
-    except httpx.RequestError:
+        return await fetch_document_answer(user_id, question)
+    except (httpx.RequestError, UpstreamUnavailable):
         raise HTTPException(status_code=503, detail="PDF analysis service is unavailable.")
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=502, detail=f"Error from PDF analysis service: {e.response.text}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
-def query_pdf_service_sync(user_id: str, question: str) -> dict:
-    """Synchronously calls the PDF query service."""
-    pdf_service_url = "http://localhost:8002/chat/"
-    data_to_forward = {'user_id': user_id, 'question': question}
+# --- DOCUMENT DEDUPLICATION ---
+# Users often re-upload the same lab report, and family members share one. Uploads are
+# hashed (SHA-256 of the file); a file we have already sent to the PDF service is not
+# parsed and indexed again, the uploader is just linked to the existing document.
+# New documents are indexed in the PDF service under a content-derived key instead of
+# the uploader's user_id, so a shared document can't be overwritten by one user's next
+# upload. Documents uploaded before this (under a user_id) still resolve to themselves.
+#
+# Since the PDF service only knows the content key, the user -> document link must outlive
+# this process: it is written to the `document_links` table (DOCUMENT_LINKS_TABLE; columns
+# user_id primary key, document_id, linked_at) and read back when this instance hasn't seen
+# the user, e.g. after a restart or on another worker. The in-memory index is a cache in front.
+DOCUMENT_LINKS_TABLE = os.environ.get("DOCUMENT_LINKS_TABLE", "document_links")
+PDF_SERVICE_UPLOAD_URL = "http://localhost:8002/upload-pdf/"
+PDF_SERVICE_CHAT_URL = "http://localhost:8002/chat/"
+
+class DocumentIndex:
+    """
+    content hash -> processed document (the upload response, with its document_id), and
+    user_id -> the document_id that user is asking about. Both maps are bounded and
+    expire (DOCUMENT_INDEX_SIZE / DOCUMENT_INDEX_TTL, which should not outlive the PDF
+    service's own retention); an evicted document is simply processed again next time.
+    """
+    def __init__(self, maxsize: int = 10000, ttl: float = 7 * 24 * 3600):
+        self._documents = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._users = TTLCache(maxsize=maxsize * 4, ttl=ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def document_key(digest: str) -> str:
+        return f"doc_{digest[:32]}"
+
+    def lookup(self, digest: str) -> dict | None:
+        with self._lock:
+            return self._documents.get(digest)
+
+    def remember(self, digest: str, result: dict):
+        with self._lock:
+            self._documents[digest] = result
+
+    def link(self, user_id: str, document_id: str):
+        with self._lock:
+            self._users[user_id] = document_id
+
+    def linked(self, user_id: str) -> str | None:
+        with self._lock:
+            return self._users.get(user_id)
+
+    def invalidate(self, document_id: str):
+        """Forgets a document (e.g. the PDF service no longer has it), so it is re-processed on the next upload."""
+        with self._lock:
+            for digest in [d for d, result in self._documents.items() if result.get("document_id") == document_id]:
+                self._documents.pop(digest, None)
+        document_answer_cache.invalidate(document_id)
+
+document_index = DocumentIndex(
+    maxsize=int(os.environ.get("DOCUMENT_INDEX_SIZE", 10000)),
+    ttl=float(os.environ.get("DOCUMENT_INDEX_TTL", 7 * 24 * 3600)),
+)
+documents_in_flight: dict[str, asyncio.Task] = {}
+
+async def link_user_document(user_id: str, document_id: str):
+    """Makes `document_id` the user's current document, here and in DOCUMENT_LINKS_TABLE.
+    If the table can't be written the link still holds on this instance."""
+    document_index.link(user_id, document_id)
+    def upsert():
+        row = {"user_id": user_id, "document_id": document_id, "linked_at": datetime.now(timezone.utc).isoformat()}
+        return get_supabase().table(DOCUMENT_LINKS_TABLE).upsert(row).execute()
     try:
-        with httpx.Client() as client:
-            # CHANGE: Use data= to send as form data instead of json=
-            response = client.post(pdf_service_url, data=data_to_forward, timeout=30.0)
-            
-            response.raise_for_status()
-            return response.json()
+        await call_upstream("supabase", lambda: asyncio.to_thread(upsert), timeout=10.0)
+    except Exception as e:
+        logger.error("Could not store document link: %s", e, extra={"event": "document_link_error"})
+
+async def user_document(user_id: str) -> str:
+    """
+    The document `user_id` uploaded last: from the in-memory index, else from
+    DOCUMENT_LINKS_TABLE. Users who uploaded before deduplication have their document
+    indexed under their own user_id, so that is the fallback. Only ever called with the
+    requesting user's own id: linked documents are never exposed by id.
+    """
+    document_id = document_index.linked(user_id)
+    if document_id is not None:
+        return document_id
+    def select():
+        return get_supabase().table(DOCUMENT_LINKS_TABLE).select("document_id").eq("user_id", user_id).limit(1).execute().data
+    try:
+        rows = await call_upstream("supabase", lambda: asyncio.to_thread(select), timeout=10.0)
+    except Exception as e:
+        logger.warning("Could not read document link: %s", e, extra={"event": "document_link_error"})
+        return user_id  # not cached, so the next question tries the table again
+    document_id = rows[0]["document_id"] if rows else user_id
+    document_index.link(user_id, document_id)
+    return document_id
+
+async def ingest_document(digest: str, filename: str, file_data: bytes, content_type: str) -> dict:
+    """
+    Sends a new document to the PDF service and records it in the index. Concurrent uploads
+    of the same file share one request to the service. Raises httpx errors and UpstreamUnavailable.
+    """
+    task = documents_in_flight.get(digest)
+    if task is None:
+        async def send() -> dict:
+            document_id = DocumentIndex.document_key(digest)
+            files = {'file': (filename, file_data, content_type)}
+            response = await call_upstream("pdf_service", lambda: get_http_client().post(PDF_SERVICE_UPLOAD_URL, files=files, data={'user_id': document_id}, timeout=60.0), timeout=60.0)
+            response.raise_for_status() # Raise an exception for 4xx or 5xx status codes
+            result = dict(response.json(), document_id=document_id)
+            document_answer_cache.invalidate(document_id)  # a forced re-parse may answer differently
+            document_index.remember(digest, result)
+            return result
+        task = asyncio.ensure_future(send())
+        documents_in_flight[digest] = task
+        task.add_done_callback(lambda _: documents_in_flight.pop(digest, None))
+    return await asyncio.shield(task)
+
+# --- DOCUMENT Q&A CACHE ---
+class DocumentAnswerCache:
+    """
+    Caches PDF-service answers per (document_id, normalized question), where document_id
+    is the key the PDF service indexed the document under. Users linked to the same
+    document share its answers.
+    """
+    def __init__(self, maxsize: int = 2048, ttl: float = 3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        return normalize_question(question)
+
+    def get(self, document_id: str, question: str) -> dict | None:
+        with self._lock:
+            return self._cache.get((document_id, self.normalize(question)))
+
+    def put(self, document_id: str, question: str, answer: dict):
+        with self._lock:
+            self._cache[(document_id, self.normalize(question))] = answer
+
+    def invalidate(self, document_id: str):
+        with self._lock:
+            for key in [k for k in self._cache.keys() if k[0] == document_id]:
+                self._cache.pop(key, None)
+
+document_answer_cache = DocumentAnswerCache(
+    maxsize=int(os.environ.get("DOCUMENT_CACHE_SIZE", 2048)),
+    ttl=float(os.environ.get("DOCUMENT_CACHE_TTL", 3600)),
+)
+
+async def fetch_document_answer(user_id: str, question: str) -> dict:
+    """Answers a question about the user's current document, using the cache and the pooled
+    async client. Raises httpx errors."""
+    document_id = await user_document(user_id)
+    cached = document_answer_cache.get(document_id, question)
+    if cached is not None:
+        return cached
+    client = get_http_client()
+    # The PDF service expects form data, not JSON
+    response = await call_upstream("pdf_service", lambda: client.post(PDF_SERVICE_CHAT_URL, data={'user_id': document_id, 'question': question}, timeout=30.0), timeout=30.0)
+    if response.status_code == 404:
+        document_index.invalidate(document_id)  # the service lost it; the next upload re-processes it
+    response.raise_for_status()
+    result = response.json()
+    if result.get("answer"):
+        document_answer_cache.put(document_id, question, result)
+    return result
+
+async def query_pdf_service(user_id: str, question: str) -> dict:
+    """Engine-side document query; never raises."""
+    try:
+        return await fetch_document_answer(user_id, question)
     except Exception as e:
-        print(f"Exception in query_pdf_service_sync: {e}")
+        logger.error("Exception in query_pdf_service: %s", e, extra={"event": "pdf_service_error"})
         return {"answer": "Sorry, I was unable to connect to the document analysis service."}
-# This is where your existing @app.post("/api/xray-upload") endpoint starts...
\ No newline at end of file
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+
+# --- ON-DEMAND SAMPLING PROFILER ---
+# Off by default and free while off: the hooks (watch_task()) only check a module global.
+# While a session runs, the engine, tool and upload code paths register their asyncio task
+# with watch_task(); a background thread wakes every `interval` seconds and records the current
+# stack of every watched task that matches the session's user_id / intent filter.
+#
+# A task's stack is its await chain (process_message -> tool -> call_upstream -> ...),
+# plus the live Python frames when it is on the CPU at that moment, so the profile shows
+# where turns spend wall-clock time: waiting on an upstream or computing. Tasks that wait on
+# gathered child tasks are followed into those children. (On Python 3.11, asyncio.wait_for
+# runs its awaitable in a separate task it doesn't expose, so time spent inside an upstream
+# call, including SDK CPU work, shows up as "(waiting)" under that call_upstream stack.)
+#
+# The result is in "folded stacks" format (one `frame;frame;frame count` line per stack),
+# which flamegraph.pl, speedscope and inferno read directly.
+#
+# The sampler reads other tasks' coroutine objects from its own thread without locking.
+# That is safe in CPython (the reads happen under the GIL), but a sample can occasionally
+# catch a task mid-switch; at these sample counts that noise is negligible.
+
+MAX_PROFILE_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 120))
+
+
+class ProfilerBusy(RuntimeError):
+    """Raised when a profiling session is already running."""
+
+
+def _label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def _thread_frames(frame) -> list:
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def _task_stacks(task: asyncio.Task, prefix: list, running_frames: list) -> list[list]:
+    """Folded stacks for `task`: its await chain, then whatever it is running or waiting on."""
+    stack = list(prefix)
+    coro, innermost = task.get_coro(), None
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        stack.append(_label(frame.f_code))
+        innermost = frame
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+
+    # On the CPU right now: append the live frames below the innermost coroutine frame
+    if innermost is not None and running_frames and any(f is innermost for f in running_frames):
+        position = next(i for i, f in enumerate(running_frames) if f is innermost)
+        return [stack + [_label(f.f_code) for f in running_frames[position + 1:]]]
+
+    waiter = getattr(task, "_fut_waiter", None)
+    if isinstance(waiter, asyncio.Task):
+        return _task_stacks(waiter, stack, running_frames)
+    children = [child for child in getattr(waiter, "_children", ()) if isinstance(child, asyncio.Task) and not child.done()]
+    if children:  # asyncio.gather
+        return [s for child in children for s in _task_stacks(child, stack, running_frames)]
+    return [stack + ["(waiting)"]]
+
+
+class ProfileSession:
+    def __init__(self, interval: float, user_id: str | None, intent: str | None):
+        self.interval = interval
+        self.user_id = user_id
+        self.intent = intent
+        self.samples = 0
+        self.stacks = Counter()
+        self._loop_thread_id = threading.get_ident()
+        self._tasks = weakref.WeakKeyDictionary()  # task -> root frame label
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="medbay-profiler", daemon=True)
+
+    def matches(self, user_id: str | None, intent: str | None) -> bool:
+        return (self.user_id is None or self.user_id == user_id) and (self.intent is None or self.intent == intent)
+
+    def add(self, task: asyncio.Task | None, label: str):
+        if task is not None:
+            self._tasks[task] = label
+
+    def _run(self):
+        next_tick = time.perf_counter()
+        while not self._stop.is_set():
+            self._sample()
+            next_tick += self.interval
+            self._stop.wait(max(0.0, next_tick - time.perf_counter()))
+
+    def _sample(self):
+        try:
+            tasks = [(task, label) for task, label in list(self._tasks.items()) if not task.done()]
+        except RuntimeError:  # the dict changed while we copied it; skip this tick
+            return
+        if not tasks:
+            return
+        running_frames = _thread_frames(sys._current_frames().get(self._loop_thread_id))
+        for task, label in tasks:
+            for stack in _task_stacks(task, [label], running_frames):
+                self.stacks[";".join(stack)] += 1
+        self.samples += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+_session: ProfileSession | None = None
+
+
+def watch_task(user_id: str | None = None, intent: str | None = None):
+    """Puts the current task under the running profiling session, if there is one and
+    it matches; its stacks are rooted at the intent. A no-op (one global lookup) when
+    profiling is off."""
+    session = _session
+    if session is not None and session.matches(user_id, intent):
+        session.add(asyncio.current_task(), intent or "request")
+
+
+async def profile_for(seconds: float, interval: float = 0.01, user_id: str | None = None, intent: str | None = None) -> ProfileSession:
+    """Samples matching tasks for `seconds` and returns the finished session."""
+    global _session
+    if _session is not None:
+        raise ProfilerBusy("A profiling session is already running.")
+    session = ProfileSession(interval, user_id, intent)
+    _session = session
+    session._thread.start()
+    try:
+        await asyncio.sleep(min(seconds, MAX_PROFILE_SECONDS))
+    finally:
+        _session = None
+        session._stop.set()
+        await asyncio.to_thread(session._thread.join)
+    return session
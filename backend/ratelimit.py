@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    """
+    In-process token-bucket rate limiter keyed by sender (WhatsApp number or web user_id).
+
+    Each sender gets `burst` tokens that refill at `rate` tokens per second; a message
+    costs one token. State is an LRU of at most `max_keys` buckets, so memory stays
+    bounded: the least recently seen sender is dropped first, and an evicted sender
+    simply starts again with a full bucket.
+    """
+    def __init__(self, rate: float, burst: int, max_keys: int = 50000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, last_refill)
+        self._lock = threading.Lock()
+
+    def allow(self, key: str, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+# One LLM call per text message, several (predict + report) per image, hence separate limits.
+message_limiter = TokenBucketLimiter(
+    rate=_env_float("RATE_LIMIT_MESSAGES_PER_MINUTE", 20) / 60,
+    burst=int(_env_float("RATE_LIMIT_MESSAGE_BURST", 10)),
+    max_keys=int(_env_float("RATE_LIMIT_MAX_SENDERS", 50000)),
+)
+media_limiter = TokenBucketLimiter(
+    rate=_env_float("RATE_LIMIT_MEDIA_PER_HOUR", 10) / 3600,
+    burst=int(_env_float("RATE_LIMIT_MEDIA_BURST", 3)),
+    max_keys=int(_env_float("RATE_LIMIT_MAX_SENDERS", 50000)),
+)
+
+RATE_LIMITED_REPLIES = {
+    "en": "⏳ You're sending messages too quickly. Please wait a moment and try again.",
+    "hi": "⏳ आप बहुत तेज़ी से संदेश भेज रहे हैं। कृपया थोड़ी देर रुककर फिर से प्रयास करें।",
+    "od": "⏳ ଆପଣ ବହୁତ ଶୀଘ୍ର ବାର୍ତ୍ତା ପଠାଉଛନ୍ତି। ଦୟାକରି କିଛି ସମୟ ଅପେକ୍ଷା କରି ପୁଣି ଚେଷ୍ଟା କରନ୍ତୁ।",
+    "ta": "⏳ நீங்கள் மிக வேகமாக செய்திகளை அனுப்புகிறீர்கள். சிறிது நேரம் காத்திருந்து மீண்டும் முயற்சிக்கவும்.",
+}
+
+RATE_LIMITED_MEDIA_REPLIES = {
+    "en": "⏳ You've sent several images recently. Please wait a while before sending another X-ray.",
+    "hi": "⏳ आपने हाल ही में कई चित्र भेजे हैं। कृपया अगला एक्स-रे भेजने से पहले कुछ देर प्रतीक्षा करें।",
+    "od": "⏳ ଆପଣ ନିକଟରେ ଅନେକ ଛବି ପଠାଇଛନ୍ତି। ଦୟାକରି ଆଉ ଏକ ଏକ୍ସ-ରେ ପଠାଇବା ପୂର୍ବରୁ କିଛି ସମୟ ଅପେକ୍ଷା କରନ୍ତୁ।",
+    "ta": "⏳ நீங்கள் சமீபத்தில் பல படங்களை அனுப்பியுள்ளீர்கள். மற்றொரு எக்ஸ்-ரே அனுப்பும் முன் சிறிது நேரம் காத்திருக்கவும்.",
+}
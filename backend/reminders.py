@@ -0,0 +1,324 @@
+import asyncio
+import calendar
+import heapq
+import itertools
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from clients import get_http_client, get_supabase_admin
+from ratelimit import TokenBucketLimiter
+from resilience import UpstreamUnavailable, call_upstream
+
+logger = logging.getLogger("medbay.reminders")
+
+# --- MEDICATION REMINDER SCHEDULER ---
+# An in-process replacement for the Node worker (worker/reminderScheduler.mjs). The `schedules` table is read once at startup (keyset-paginated, ids and times
+# only) into a min-heap keyed by fire time; after that only rows created since the last
+# sync are fetched (REMINDER_SYNC_COLUMN, default created_at; set it to an updated_at
+# column, if the table has one, to also pick up edits). Nothing is re-scanned.
+#
+# When reminders come due they are handled in batches: one query re-reads the due rows
+# (so deleted or already-handled schedules are never sent), the SMS go out concurrently
+# over the pooled HTTP client under a token-bucket send rate, and the results are written
+# back with one delete for one-time reminders, one update per distinct next fire time for
+# recurring ones, and one update for one-time reminders Twilio rejected. Transient Twilio
+# errors (429, 5xx, network) are retried until the reminder is too late; a recurring
+# reminder whose send is rejected still moves on to its next occurrence.
+#
+# Off by default, because the Node worker is still the sender in existing deployments.
+# To switch, stop the worker and set REMINDER_SCHEDULER=1 on exactly one instance: two
+# senders (two instances, or an instance and the worker) would both send every reminder.
+
+REMINDER_SCHEDULER = os.environ.get("REMINDER_SCHEDULER", "0") == "1"
+REMINDER_SYNC_SECONDS = float(os.environ.get("REMINDER_SYNC_SECONDS", 30))
+REMINDER_SYNC_COLUMN = os.environ.get("REMINDER_SYNC_COLUMN", "created_at")
+REMINDER_SYNC_OVERLAP_SECONDS = 120  # re-read a little history to cover clock skew and late commits
+REMINDER_BATCH_SIZE = int(os.environ.get("REMINDER_BATCH_SIZE", 100))
+REMINDER_SEND_CONCURRENCY = int(os.environ.get("REMINDER_SEND_CONCURRENCY", 10))
+REMINDER_SENDS_PER_SECOND = float(os.environ.get("REMINDER_SENDS_PER_SECOND", 10))  # match your Twilio sender's throughput
+REMINDER_MAX_LATENESS_SECONDS = float(os.environ.get("REMINDER_MAX_LATENESS_SECONDS", 24 * 3600))
+REMINDER_RETRY_SECONDS = 60
+PAGE_SIZE = 1000
+
+TWILIO_MESSAGES_URL = "https://api.twilio.com/2010-04-01/Accounts/{account_sid}/Messages.json"
+
+
+def parse_timestamp(value: str) -> datetime:
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _add_months(moment: datetime, months: int) -> datetime:
+    index = moment.month - 1 + months
+    year, month = moment.year + index // 12, index % 12 + 1
+    return moment.replace(year=year, month=month, day=min(moment.day, calendar.monthrange(year, month)[1]))
+
+
+def next_occurrence(moment: datetime, recurring_type: str, after: datetime) -> datetime | None:
+    """The first occurrence of a recurring reminder later than `after`; None for one-time reminders."""
+    steps = {
+        "daily": lambda m: m + timedelta(days=1),
+        "weekly": lambda m: m + timedelta(weeks=1),
+        "monthly": lambda m: _add_months(m, 1),
+    }
+    step = steps.get(recurring_type)
+    if step is None:
+        return None
+    moment = step(moment)
+    while moment <= after:  # skip occurrences missed while nothing was running
+        moment = step(moment)
+    return moment
+
+
+def reminder_text(schedule: dict) -> str:
+    return f"MedBay Alert: Time for your medication! 💊 {schedule['medicine_name']}, Dosage: {schedule['dosage']}. Stay healthy!"
+
+
+class ReminderScheduler:
+    """In-process reminder scheduler; see the module comment."""
+    def __init__(self, batch_size: int = REMINDER_BATCH_SIZE, sends_per_second: float = REMINDER_SENDS_PER_SECOND,
+                 send_concurrency: int = REMINDER_SEND_CONCURRENCY):
+        self.batch_size = batch_size
+        self.limiter = TokenBucketLimiter(rate=sends_per_second, burst=max(1, int(sends_per_second)), max_keys=1)
+        self.send_concurrency = send_concurrency
+        self.counts = {"sent": 0, "failed": 0, "skipped_late": 0}
+        self._fire_at = {}  # schedule id -> fire time (epoch seconds); the heap may hold stale entries
+        self._heap = []
+        self._sequence = itertools.count()
+        self._watermark = None
+        self._wakeup = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._fire_at)
+
+    def stats(self) -> dict:
+        return {"pending": len(self), "running": self._task is not None and not self._task.done(), **self.counts}
+
+    # --- local state ---
+    def schedule(self, schedule_id, fire_at: float):
+        if self._fire_at.get(schedule_id) == fire_at:
+            return
+        self._fire_at[schedule_id] = fire_at
+        heapq.heappush(self._heap, (fire_at, next(self._sequence), schedule_id))
+        if self._wakeup is not None and self._heap[0][2] == schedule_id:
+            self._wakeup.set()  # earlier than whatever the loop is sleeping towards
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            fire_at, _, schedule_id = heapq.heappop(self._heap)
+            if self._fire_at.get(schedule_id) == fire_at:  # otherwise it was rescheduled
+                del self._fire_at[schedule_id]
+                due.append(schedule_id)
+        return due
+
+    def _next_fire_at(self) -> float | None:
+        while self._heap and self._fire_at.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)  # drop stale entries
+        return self._heap[0][0] if self._heap else None
+
+    # --- Supabase ---
+    async def _query(self, build):
+        """Runs `build(table).execute()` in a thread through the 'supabase' breaker; returns the rows."""
+        def run():
+            return build(get_supabase_admin().table("schedules")).execute().data
+        return await call_upstream("supabase", lambda: asyncio.to_thread(run), timeout=30.0)
+
+    def _add_rows(self, rows: list):
+        for row in rows:
+            try:
+                self.schedule(row["id"], parse_timestamp(row["scheduled_at"]).timestamp())
+            except (KeyError, TypeError, ValueError, AttributeError):
+                logger.warning("Schedule %s has no valid scheduled_at", row.get("id"), extra={"event": "reminder_invalid"})
+
+    async def load_all(self):
+        """Reads every pending schedule once (ids and times only), a page at a time."""
+        self._watermark = datetime.now(timezone.utc)
+        last_id = None
+        while True:
+            def page(table, after=last_id):
+                query = table.select("id, scheduled_at").eq("status", "scheduled").order("id").limit(PAGE_SIZE)
+                return query.gt("id", after) if after is not None else query
+            rows = await self._query(page)
+            self._add_rows(rows)
+            if len(rows) < PAGE_SIZE:
+                break
+            last_id = rows[-1]["id"]
+        logger.info("Loaded %d pending reminders", len(self), extra={"event": "reminders_loaded"})
+
+    async def sync_changes(self):
+        """Picks up schedules created (or, with an updated_at sync column, changed) since the last sync."""
+        started = datetime.now(timezone.utc)
+        since = (self._watermark - timedelta(seconds=REMINDER_SYNC_OVERLAP_SECONDS)).isoformat()
+        offset = 0
+        while True:
+            def page(table, start=offset):
+                return (table.select("id, scheduled_at").eq("status", "scheduled").gte(REMINDER_SYNC_COLUMN, since)
+                        .order(REMINDER_SYNC_COLUMN).order("id").range(start, start + PAGE_SIZE - 1))
+            rows = await self._query(page)
+            self._add_rows(rows)
+            if len(rows) < PAGE_SIZE:
+                break
+            offset += PAGE_SIZE
+        self._watermark = started
+
+    # --- sending ---
+    async def _send(self, schedule: dict, semaphore: asyncio.Semaphore) -> bool | None:
+        """True if sent, False if Twilio rejected it for good, None on a transient error (retry later)."""
+        account_sid = os.environ.get("TWILIO_ACCOUNT_SID")
+        auth_token = os.environ.get("TWILIO_AUTH_TOKEN")
+        from_number = os.environ.get("TWILIO_PHONE_NUMBER")
+        async with semaphore:
+            while not self.limiter.allow("twilio"):
+                await asyncio.sleep(1 / self.limiter.rate)
+            if not (account_sid and auth_token and from_number):
+                logger.info("Simulated reminder SMS for schedule %s", schedule["id"], extra={"event": "reminder_simulated"})
+                return True
+            url = TWILIO_MESSAGES_URL.format(account_sid=account_sid)
+            data = {"To": schedule["user_phone_number"], "From": from_number, "Body": reminder_text(schedule)}
+            try:
+                response = await call_upstream("twilio_sms", lambda: get_http_client().post(url, data=data, auth=(account_sid, auth_token)), timeout=15.0)
+            except UpstreamUnavailable:
+                return None
+            except Exception as e:
+                logger.warning("Reminder SMS for schedule %s not sent, will retry: %s", schedule["id"], e, extra={"event": "reminder_retry"})
+                return None
+            if response.status_code == 429 or response.status_code >= 500:
+                logger.warning("Twilio answered %d for schedule %s, will retry", response.status_code, schedule["id"], extra={"event": "reminder_retry"})
+                return None
+            try:
+                response.raise_for_status()
+                return True
+            except Exception as e:
+                logger.warning("Reminder SMS for schedule %s failed: %s", schedule["id"], e, extra={"event": "reminder_failed"})
+                return False
+
+    async def dispatch(self, schedule_ids: list):
+        """Re-reads the due schedules, sends them and records the outcome, all in batches."""
+        try:
+            rows = await self._query(lambda table: table.select("*").in_("id", schedule_ids).eq("status", "scheduled"))
+        except Exception as e:
+            logger.warning("Could not read %d due reminders: %s", len(schedule_ids), e, extra={"event": "reminder_retry"})
+            self._retry(schedule_ids)
+            return
+
+        now = datetime.now(timezone.utc)
+        to_send, advance_only = [], []
+        for row in rows:  # ids missing here were deleted or handled elsewhere
+            try:
+                scheduled_at = parse_timestamp(row["scheduled_at"])
+            except (KeyError, TypeError, ValueError, AttributeError):
+                # Edited since we loaded it; dropped like invalid rows in _add_rows (sync re-adds it once fixed)
+                logger.warning("Schedule %s has no valid scheduled_at", row.get("id"), extra={"event": "reminder_invalid"})
+                continue
+            if scheduled_at > now + timedelta(seconds=1):
+                self.schedule(row["id"], scheduled_at.timestamp())  # moved later since we loaded it
+            elif (now - scheduled_at).total_seconds() > REMINDER_MAX_LATENESS_SECONDS:
+                self.counts["skipped_late"] += 1
+                advance_only.append(row)
+            else:
+                to_send.append(row)
+
+        semaphore = asyncio.Semaphore(self.send_concurrency)
+        outcomes = await asyncio.gather(*(self._send(row, semaphore) for row in to_send))
+        sent = [row for row, outcome in zip(to_send, outcomes) if outcome is True]
+        failed = [row for row, outcome in zip(to_send, outcomes) if outcome is False]
+        self._retry([row["id"] for row, outcome in zip(to_send, outcomes) if outcome is None])
+        self.counts["sent"] += len(sent)
+        self.counts["failed"] += len(failed)
+        await self._record(sent, advance_only, failed, now)
+
+    async def _record(self, sent: list, advance_only: list, failed: list, now: datetime):
+        one_time, next_runs, rejected = [], {}, []
+        outcomes = [(row, "sent") for row in sent] + [(row, "late") for row in advance_only] + [(row, "failed") for row in failed]
+        for row, outcome in outcomes:
+            next_at = next_occurrence(parse_timestamp(row["scheduled_at"]), row.get("recurring_type"), after=now)
+            if next_at is not None:
+                # Recurring: move on to the next occurrence whatever happened to this one
+                next_runs.setdefault(next_at.isoformat(), []).append(row["id"])
+            elif outcome == "late":
+                continue  # a one-time reminder we are too late for stays as it is, like with the old worker
+            elif row.get("recurring_type") != "once":
+                logger.warning("Unknown recurring_type %r for schedule %s", row.get("recurring_type"), row["id"], extra={"event": "reminder_invalid"})
+                rejected.append(row["id"])
+            elif outcome == "sent":
+                one_time.append(row["id"])
+            else:
+                rejected.append(row["id"])
+
+        writes = []
+        if one_time:
+            writes.append(lambda table: table.delete().in_("id", one_time))
+        for next_iso, ids in next_runs.items():  # reminders due together usually recur together
+            writes.append(lambda table, ids=ids, next_iso=next_iso: table.update({"scheduled_at": next_iso, "status": "scheduled"}).in_("id", ids))
+        if rejected:
+            writes.append(lambda table: table.update({"status": "error"}).in_("id", rejected))
+        for write in writes:
+            try:
+                await self._query(write)
+            except Exception as e:
+                logger.error("Could not record reminder results: %s", e, extra={"event": "reminder_write_error"})
+        for next_iso, ids in next_runs.items():
+            for schedule_id in ids:
+                self.schedule(schedule_id, parse_timestamp(next_iso).timestamp())
+
+    def _retry(self, schedule_ids: list):
+        retry_at = time.time() + REMINDER_RETRY_SECONDS
+        for schedule_id in schedule_ids:
+            self.schedule(schedule_id, retry_at)
+
+    # --- lifecycle ---
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                await self.load_all()
+                break
+            except Exception as e:
+                logger.error("Could not load reminders, retrying: %s", e, extra={"event": "reminders_load_error"})
+                await asyncio.sleep(REMINDER_RETRY_SECONDS)
+
+        next_sync = time.monotonic() + REMINDER_SYNC_SECONDS
+        while True:
+            if time.monotonic() >= next_sync:
+                try:
+                    await self.sync_changes()
+                except Exception as e:
+                    logger.warning("Reminder sync failed: %s", e, extra={"event": "reminders_sync_error"})
+                next_sync = time.monotonic() + REMINDER_SYNC_SECONDS
+            due = self._pop_due(time.time())
+            if due:
+                try:
+                    await self.dispatch(due)
+                except Exception as e:
+                    logger.exception("Reminder dispatch failed, retrying: %s", e, extra={"event": "reminder_dispatch_error"})
+                    self._retry(due)
+                continue
+            sleep_for = next_sync - time.monotonic()
+            next_fire = self._next_fire_at()
+            if next_fire is not None:
+                sleep_for = min(sleep_for, next_fire - time.time())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, sleep_for))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+reminder_scheduler = ReminderScheduler()
@@ -0,0 +1,33 @@
+from fpdf import FPDF
+
+
+class PDF(FPDF):
+    def header(self):
+        self.set_font('Arial', 'B', 15)
+        self.cell(0, 10, 'MedBay - AI Chest X-Ray Analysis Report', 0, 1, 'C')
+        self.ln(5)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('Arial', 'I', 8)
+        self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
+        
+    def chapter_title(self, title):
+        self.set_font('Arial', 'B', 12)
+        self.cell(0, 10, title, 0, 1, 'L')
+        self.ln(2)
+
+    def chapter_body(self, body):
+        self.set_font('Arial', '', 11)
+        self.multi_cell(0, 5, body)
+        self.ln()
+
+    def analysis_table(self, results):
+        self.set_font('Arial', 'B', 11)
+        self.cell(150, 10, 'Condition Detected', 1, 0, 'C')
+        self.cell(40, 10, 'Probability', 1, 1, 'C')
+        self.set_font('Arial', '', 11)
+        for item in results[:5]: # Top 5 results
+            self.cell(150, 10, item['label'], 1, 0)
+            self.cell(40, 10, f"{item['probability'] * 100:.1f}%", 1, 1, 'C')
+        self.ln()
@@ -0,0 +1,219 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from traces import current_replay, current_turn
+
+# --- LATENCY BUDGETS ---
+# A request sets an absolute deadline once; every upstream call made while handling it
+# (including calls in asyncio.to_thread, which copies the context) sees the same deadline
+# and caps its own timeout to whatever is left.
+
+_deadline: ContextVar[float | None] = ContextVar("medbay_deadline", default=None)
+
+
+class UpstreamUnavailable(Exception):
+    """An upstream call was skipped or abandoned; callers should degrade, not retry."""
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    pass
+
+
+@contextmanager
+def latency_budget(seconds: float):
+    """Sets a deadline `seconds` from now for everything awaited inside the block.
+    A nested budget can only shorten an outer one, never extend it."""
+    deadline = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        deadline = min(deadline, outer)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_budget() -> float | None:
+    """Seconds left in the current request's budget, or None if no budget is set."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+# --- CIRCUIT BREAKERS ---
+class CircuitBreaker:
+    """
+    Classic closed -> open -> half-open breaker. After `failure_threshold` consecutive
+    failures the circuit opens and calls fail fast for `reset_timeout` seconds; then a
+    single trial call is let through, and its outcome closes or re-opens the circuit.
+    """
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release(self):
+        """Ends a call without a verdict (e.g. the caller was cancelled)."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(
+                name,
+                failure_threshold=int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5)),
+                reset_timeout=float(os.environ.get("BREAKER_RESET_SECONDS", 30)),
+            ))
+    return breaker
+
+
+def breaker_states() -> dict:
+    return {name: breaker.state for name, breaker in _breakers.items()}
+
+
+def _is_upstream_fault(exc: Exception) -> bool:
+    """Client errors (4xx) mean *our* request was bad, not that the upstream is unhealthy."""
+    response = getattr(exc, "response", None)
+    status_code = getattr(response, "status_code", None)
+    return not (isinstance(status_code, int) and 400 <= status_code < 500)
+
+
+def _is_error_response(result) -> bool:
+    """HTTP responses come back without raising (callers run raise_for_status() themselves),
+    so a 5xx has to be recognized from the result."""
+    status_code = getattr(result, "status_code", None)
+    return isinstance(status_code, int) and status_code >= 500
+
+
+# --- UPSTREAM CALLS ---
+async def _hedged(make_call, hedge_after: float):
+    """Starts a second identical call if the first hasn't finished after `hedge_after`
+    seconds and returns whichever succeeds first. Only use for idempotent requests."""
+    tasks = [asyncio.ensure_future(make_call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            tasks.append(asyncio.ensure_future(make_call()))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call_upstream(name: str, make_call, timeout: float, hedge_after: float | None = None):
+    """
+    Runs `make_call()` (a zero-argument coroutine factory) guarded by the `name` circuit
+    breaker and capped by both `timeout` and the current request's remaining budget.
+    Raises CircuitOpenError / DeadlineExceeded instead of waiting on a sick upstream.
+    While a conversation trace is being recorded or replayed (traces.py), the call is
+    recorded, or answered from the recording without calling the upstream at all.
+    """
+    replay = current_replay()
+    if replay is not None:
+        return await replay.respond(name)
+    turn = current_turn()
+    if turn is None:
+        return await _guarded_call(name, make_call, timeout, hedge_after)
+    started = time.perf_counter()
+    try:
+        result = await _guarded_call(name, make_call, timeout, hedge_after)
+    except BaseException as e:
+        turn.upstream(name, started, error=e)
+        raise
+    turn.upstream(name, started, result=result)
+    return result
+
+
+async def _guarded_call(name: str, make_call, timeout: float, hedge_after: float | None):
+    budget = remaining_budget()
+    if budget is not None and budget <= 0:
+        raise DeadlineExceeded(f"no budget left for {name}")
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"{name} circuit is open")
+    effective_timeout = timeout if budget is None else min(timeout, budget)
+    call = _hedged(make_call, hedge_after) if hedge_after else make_call()
+    try:
+        result = await asyncio.wait_for(call, effective_timeout)
+    except asyncio.TimeoutError:
+        # Only the upstream's own deadline says it is slow; running out of request budget
+        # (a shorter effective_timeout) says nothing about its health.
+        if effective_timeout == timeout:
+            breaker.record_failure()
+        else:
+            breaker.release()
+        raise DeadlineExceeded(f"{name} did not answer within {effective_timeout:.1f}s")
+    except asyncio.CancelledError:
+        breaker.release()  # cancelled by the caller or an outer budget, not failed
+        raise
+    except Exception as e:
+        if _is_upstream_fault(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    if _is_error_response(result):
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return result
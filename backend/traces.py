@@ -0,0 +1,289 @@
+import asyncio
+import hashlib
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import orjson
+
+from logs import redact
+
+logger = logging.getLogger("medbay.traces")
+
+# --- CONVERSATION TRACES ---
+# With TRACE_FILE set, a sample of conversations is recorded turn by turn to an append-only
+# NDJSON file: the (anonymized) input, the intent before and after, the total latency and
+# every call_upstream() made while handling it, with its latency and a compact copy of what
+# the upstream returned. Conversations are sampled by user (TRACE_SAMPLE_RATE), so a trace
+# always holds whole conversations. Lines are written by a background thread and dropped,
+# never waited on, if the writer falls behind.
+#
+# `python benchmark.py replay TRACE_FILE` feeds the recorded turns back through the current
+# engine with every upstream answered from the recording (see Replay), and compares latency,
+# LLM calls and intents against what was recorded.
+#
+# User IDs are replaced by salted hashes (TRACE_SALT) and phone numbers are masked in all
+# recorded text. Without TRACE_SALT a random salt is used for the life of the process: an
+# unsalted hash of a phone number can be reversed by trying every number, but then the same
+# user gets a different pseudonym after a restart.
+
+TRACE_VERSION = 1
+
+_current_turn: ContextVar["TraceTurn | None"] = ContextVar("medbay_trace_turn", default=None)
+_current_replay: ContextVar["Replay | None"] = ContextVar("medbay_trace_replay", default=None)
+
+
+_process_salt = secrets.token_hex(16)
+
+
+def pseudonymize(value: str) -> str:
+    salt = os.environ.get("TRACE_SALT") or _process_salt
+    return "u_" + hashlib.sha256(f"{salt}{value}".encode("utf-8")).hexdigest()[:12]
+
+
+def _anonymize(value):
+    if isinstance(value, str):
+        return redact(value)
+    if isinstance(value, dict):
+        return {key: pseudonymize(str(item)) if key in ("document_id", "user_id") else _anonymize(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_anonymize(item) for item in value]
+    return value
+
+
+def snapshot_result(result) -> dict:
+    """A JSON-able copy of an upstream result, enough to rebuild it in replay."""
+    if hasattr(result, "status_code") and hasattr(result, "content"):  # httpx.Response
+        return {"type": "http", "status": result.status_code,
+                "content_type": result.headers.get("content-type"), "body": redact(result.text)}
+    if hasattr(result, "candidates"):  # Gemini GenerateContentResponse
+        try:
+            text = redact(result.text)
+        except ValueError:  # blocked or empty candidate
+            text = None
+        usage = getattr(result, "usage_metadata", None)
+        tokens = {"in": usage.prompt_token_count, "out": usage.candidates_token_count} if usage else None
+        return {"type": "llm", "text": text, "tokens": tokens}
+    return {"type": "value", "value": _anonymize(result)}
+
+
+class TraceTurn:
+    """What one process_message turn did; filled in while it runs, written when it ends."""
+    __slots__ = ("record", "_started")
+
+    def __init__(self, user_id: str, text: str, language: str, context: dict | None, intent_before: str | None):
+        self._started = time.perf_counter()
+        self.record = {
+            "v": TRACE_VERSION,
+            "ts": round(time.time(), 3),
+            "conversation": pseudonymize(user_id),
+            "input": {"text": redact(text), "language": language, "context": _anonymize(context)},
+            "intent_before": intent_before,
+            "upstream": [],
+        }
+
+    def upstream(self, name: str, started: float, result=None, error: BaseException | None = None):
+        call = {"name": name, "ms": round((time.perf_counter() - started) * 1000, 1)}
+        if error is not None:
+            call["error"] = {"type": type(error).__name__, "message": redact(str(error))[:200]}
+        else:
+            call["result"] = snapshot_result(result)
+        self.record["upstream"].append(call)
+
+    def finish(self, intent_after: str | None, reply: str | None, degraded: bool):
+        self.record.update(
+            intent_after=intent_after,
+            reply_chars=len(reply or ""),
+            degraded=degraded,
+            ms=round((time.perf_counter() - self._started) * 1000, 1),
+        )
+
+
+class TraceWriter:
+    """Appends trace lines from a background thread; drops lines when the queue is full."""
+    def __init__(self, path: str, max_pending: int = 1000):
+        self.path = path
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name="medbay-trace-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "ab") as f:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    break
+                f.write(orjson.dumps(record, default=str) + b"\n")
+                if self._queue.empty():
+                    f.flush()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer() -> TraceWriter | None:
+    global _writer
+    path = os.environ.get("TRACE_FILE")
+    if not path:
+        return None
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                if not os.environ.get("TRACE_SALT"):
+                    logger.warning("TRACE_SALT is not set; using a random per-process salt, so pseudonyms change on restart", extra={"event": "trace_salt"})
+                _writer = TraceWriter(path)
+    return _writer
+
+
+def should_trace(user_id: str) -> bool:
+    """Deterministic per-user sampling, so a sampled conversation is recorded in full."""
+    if not os.environ.get("TRACE_FILE") or TRACE_SAMPLE_RATE <= 0 or _current_replay.get() is not None:
+        return False
+    bucket = int(hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return bucket < TRACE_SAMPLE_RATE
+
+
+def start_turn(user_id: str, text: str, language: str, context: dict | None, intent_before: str | None) -> TraceTurn:
+    turn = TraceTurn(user_id, text, language, context, intent_before)
+    _current_turn.set(turn)
+    return turn
+
+
+def end_turn(turn: TraceTurn, intent_after: str | None, reply: str | None, degraded: bool = False):
+    turn.finish(intent_after, reply, degraded)
+    _current_turn.set(None)
+    writer = _get_writer()
+    if writer is not None:
+        writer.write(turn.record)
+
+
+def current_turn() -> TraceTurn | None:
+    return _current_turn.get()
+
+
+def close_trace_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+
+
+# --- REPLAY ---
+class ReplayedUpstreamError(Exception):
+    """Stands in for an upstream error that was recorded as something other than UpstreamUnavailable."""
+
+
+class _RecordedLLMResponse:
+    def __init__(self, text: str | None):
+        self._text = text
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            raise ValueError("The recorded response had no text.")
+        return self._text
+
+
+class Replay:
+    """
+    Answers call_upstream() from one recorded turn: calls are matched per upstream name in
+    recorded order, and each one waits its recorded latency (scaled by `speed`; 0 skips the
+    wait) before returning a rebuilt result or raising the recorded error. Calls the current
+    code makes that the recording doesn't have are counted as unmatched and fail with
+    ReplayedUpstreamError, which the engine handles like any other upstream failure.
+    """
+    def __init__(self, record: dict, speed: float = 1.0):
+        self.speed = speed
+        self.calls = defaultdict(int)
+        self.unmatched = defaultdict(int)
+        self._recorded = defaultdict(deque)
+        for call in record.get("upstream", []):
+            self._recorded[call["name"]].append(call)
+
+    @property
+    def leftover(self) -> int:
+        """Recorded calls the current code no longer makes."""
+        return sum(len(calls) for calls in self._recorded.values())
+
+    async def respond(self, name: str):
+        self.calls[name] += 1
+        recorded = self._recorded[name]
+        if not recorded:
+            self.unmatched[name] += 1
+            raise ReplayedUpstreamError(f"no recorded response left for {name}")
+        call = recorded.popleft()
+        if self.speed:
+            await asyncio.sleep(call["ms"] / 1000 * self.speed)
+        if "error" in call:
+            raise _rebuild_error(call["error"])
+        return rebuild_result(call["result"])
+
+
+def _rebuild_error(error: dict) -> Exception:
+    from resilience import CircuitOpenError, DeadlineExceeded, UpstreamUnavailable
+    kinds = {cls.__name__: cls for cls in (CircuitOpenError, DeadlineExceeded, UpstreamUnavailable)}
+    kinds["CancelledError"] = DeadlineExceeded  # the turn's budget ran out while waiting on it
+    return kinds.get(error["type"], ReplayedUpstreamError)(error["message"])
+
+
+def rebuild_result(snapshot: dict):
+    if snapshot["type"] == "http":
+        import httpx
+        headers = {"content-type": snapshot["content_type"]} if snapshot.get("content_type") else None
+        return httpx.Response(snapshot["status"], content=snapshot["body"].encode("utf-8"), headers=headers,
+                              request=httpx.Request("GET", "http://replay.invalid/"))
+    if snapshot["type"] == "llm":
+        return _RecordedLLMResponse(snapshot["text"])
+    return snapshot["value"]
+
+
+def current_replay() -> Replay | None:
+    return _current_replay.get()
+
+
+@contextmanager
+def replaying(replay: Replay):
+    """Answers every call_upstream() awaited inside the block from `replay`."""
+    token = _current_replay.set(replay)
+    try:
+        yield replay
+    finally:
+        _current_replay.reset(token)
+
+
+def load_traces(path: str) -> dict[str, list[dict]]:
+    """Recorded turns grouped by conversation, each conversation in recorded order."""
+    conversations = defaultdict(list)
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                record = orjson.loads(line)
+                if record.get("v") == TRACE_VERSION:
+                    conversations[record["conversation"]].append(record)
+    for turns in conversations.values():
+        turns.sort(key=lambda record: record["ts"])
+    return dict(conversations)
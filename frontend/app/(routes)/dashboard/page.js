@@ -2,7 +2,7 @@
 
 import React, { useState, useEffect } from 'react';
 import Sidebar from '@/components/sidebar';
-import { getHealthStatsMultipleYears, getDiseaseStatsMultipleYears, getLifeExpectancyMultipleYears } from '@/lib/healthStats';
+import { getDashboardStats } from '@/services/api';
 import StatCard from '@/components/dashboard/StatCard';
 import InteractiveStatsCards from '@/components/dashboard/InteractiveStatsCards';
 import NewsFeed from '@/components/dashboard/NewsFeed';
@@ -138,19 +138,26 @@ const QuickActionsPanel = () => {
     );
 };
 
+const DASHBOARD_YEARS = [2019, 2020, 2021, 2022, 2023, 2024];
+
 async function getDashboardData() {
-    const healthStats = await getHealthStatsMultipleYears([2024, 2023, 2022, 2021, 2020, 2019]);
-    const diseaseStats = await getDiseaseStatsMultipleYears([2019, 2020, 2021, 2022, 2023, 2024]);
-    const lifeExpectancyStats = await getLifeExpectancyMultipleYears([2019, 2020, 2021, 2022, 2023, 2024]);
+    // One precomputed response from the backend; if it fails the dashboard still renders, empty
+    let healthStats = {};
+    try {
+        healthStats = await getDashboardStats();
+    } catch (error) {
+        console.error('Error fetching dashboard stats:', error);
+    }
+    const records = (healthStats.records || []).filter(record => DASHBOARD_YEARS.includes(record.year));
 
     const apiKey = process.env.NEXT_PUBLIC_GNEWS_API_KEY;
     const newsResponse = await fetch(`https://gnews.io/api/v4/top-headlines?country=in&category=health&max=6&apikey=${apiKey}`);
     const newsData = await newsResponse.json();
 
     return {
-        stats: healthStats || [],
-        diseaseStats: diseaseStats || [],
-        lifeExpectancyStats: lifeExpectancyStats || [],
+        stats: records,
+        diseaseStats: records,
+        yearlyStats: healthStats.yearly || null,
         news: newsData.articles || [],
     };
 }
@@ -250,7 +257,7 @@ function DashboardWithSidebar() {
                                         <Heart size={24} className="text-purple-400" />
                                         <h2 className="text-2xl font-bold text-white">Health Trends</h2>
                                     </div>
-                                    <HealthTrendsChart lifeExpectancyData={dashboardData.lifeExpectancyStats} />
+                                    <HealthTrendsChart yearlyData={dashboardData.yearlyStats} />
                                 </EnhancedGlowCard>
 
                                 <EnhancedGlowCard glowColor="orange" className="p-6">
@@ -3,7 +3,7 @@
 import { useState, useEffect, useRef } from 'react';
 import { IoMdSend } from 'react-icons/io';
 import { MapPin, Mic, Upload } from 'lucide-react';
-import { sendMessageToBot } from '../services/api';
+import { getWebUserId, sendMessageToBot } from '../services/api';
 import HospitalCard from '@/components/HospitalCard';
 import MessageBubble from '@/components/MessageBubble';
 import XrayUpload from '@/components/XrayUpload';
@@ -87,7 +87,7 @@ export default function Chat() {
             if (isDocumentContextActive) {
                 // --- Document Query Logic ---
                 const formData = new FormData();
-                formData.append('user_id', 'webapp_user_123');
+                formData.append('user_id', getWebUserId());
                 formData.append('question', textToSend);
                 
                 const responseData = await queryDocument(formData);
@@ -99,7 +99,7 @@ export default function Chat() {
                 // --- General Chat & X-ray Logic ---
                 const messagePayload = { 
                     message: {
-                        user_id: 'webapp_user_123', 
+                        user_id: getWebUserId(), 
                         text: textToSend, 
                         language: 'en',
                         context: context 
@@ -196,7 +196,8 @@ export default function Chat() {
 
     const handleDocumentUploadComplete = (result) => {
         // 1. Set the context to activate "document followup" mode on the backend
-        setContext({ document_id: 'webapp_user_123' }); // Using user_id as a unique ID for the doc
+        // The backend answers from the document this user uploaded last; document_id only switches the mode
+        setContext({ document_id: result?.document_id || getWebUserId() });
     
         // 2. Add a confirmation message directly to the chat interface
         const successMessage = {
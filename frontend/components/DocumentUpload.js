@@ -2,7 +2,7 @@
 
 import { AlertCircle, CheckCircle, FileText, Upload, X } from 'lucide-react';
 import { useRef, useState } from 'react';
-import { uploadDocument } from '../services/api'; // <-- IMPORTANT: Use the new API function
+import { getWebUserId, uploadDocument } from '../services/api'; // <-- IMPORTANT: Use the new API function
 
 // THIS IS INCORRECT IN THIS FILE
 export const config = {
@@ -59,7 +59,7 @@ const DocumentUpload = ({ onUploadComplete, onUploadError }) => {
 
     const formData = new FormData();
     formData.append('file', selectedFile);
-    formData.append('user_id', 'webapp_user_123'); // Or your dynamic user ID
+    formData.append('user_id', getWebUserId());
 
     try {
       const result = await uploadDocument(formData); // <-- CHANGED: Call the correct API
@@ -5,35 +5,22 @@ import { Chart as ChartJS, CategoryScale, LinearScale, PointElement, LineElement
 
 ChartJS.register(CategoryScale, LinearScale, PointElement, LineElement, Title, Tooltip, Legend);
 
-const HealthTrendsChart = ({ lifeExpectancyData }) => {
-    // Prepare chart data from life expectancy data
+const HealthTrendsChart = ({ yearlyData }) => {
+    // Prepare chart data from the per-year averages computed by the backend
     const getChartData = () => {
         const years = ['2019', '2020', '2021', '2022', '2023', '2024'];
-        
-        // Aggregate data by year (since we have multiple countries)
-        const yearlyData = years.map(year => {
-            const yearRecords = lifeExpectancyData.filter(record => record.year === parseInt(year));
-            
-            if (yearRecords.length === 0) {
+
+        const yearlyAverages = years.map(year => {
+            const index = yearlyData ? yearlyData.years.indexOf(parseInt(year)) : -1;
+            if (index === -1) {
                 return { year, maleAvg: null, femaleAvg: null };
             }
-            
-            // Calculate average life expectancy for the year (excluding null values)
-            const validMaleRecords = yearRecords.filter(r => r.life_expectancy_male_years !== null);
-            const validFemaleRecords = yearRecords.filter(r => r.life_expectancy_female_years !== null);
-            
-            const maleAvg = validMaleRecords.length > 0 
-                ? validMaleRecords.reduce((sum, r) => sum + r.life_expectancy_male_years, 0) / validMaleRecords.length
-                : null;
-            
-            const femaleAvg = validFemaleRecords.length > 0 
-                ? validFemaleRecords.reduce((sum, r) => sum + r.life_expectancy_female_years, 0) / validFemaleRecords.length
-                : null;
-            
+            const maleAvg = yearlyData.life_expectancy_male_years[index];
+            const femaleAvg = yearlyData.life_expectancy_female_years[index];
             return {
                 year,
-                maleAvg: maleAvg ? parseFloat(maleAvg.toFixed(1)) : null,
-                femaleAvg: femaleAvg ? parseFloat(femaleAvg.toFixed(1)) : null
+                maleAvg: maleAvg !== null ? parseFloat(maleAvg.toFixed(1)) : null,
+                femaleAvg: femaleAvg !== null ? parseFloat(femaleAvg.toFixed(1)) : null
             };
         });
         
@@ -42,7 +29,7 @@ const HealthTrendsChart = ({ lifeExpectancyData }) => {
             datasets: [
                 {
                     label: 'Male Life Expectancy (Years)',
-                    data: yearlyData.map(d => d.maleAvg),
+                    data: yearlyAverages.map(d => d.maleAvg),
                     borderColor: '#3b82f6',
                     backgroundColor: 'rgba(59, 130, 246, 0.1)',
                     borderWidth: 3,
@@ -55,7 +42,7 @@ const HealthTrendsChart = ({ lifeExpectancyData }) => {
                 },
                 {
                     label: 'Female Life Expectancy (Years)',
-                    data: yearlyData.map(d => d.femaleAvg),
+                    data: yearlyAverages.map(d => d.femaleAvg),
                     borderColor: '#ec4899',
                     backgroundColor: 'rgba(236, 72, 153, 0.1)',
                     borderWidth: 3,
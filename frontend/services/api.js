@@ -6,6 +6,19 @@ const apiClient = axios.create({
   baseURL: 'http://localhost:8000',
 });
 
+// --- WEB USER ID ---
+// Each browser gets its own id, kept in localStorage, so conversation state and the
+// backend's per-sender rate limits apply per visitor instead of to the whole web app.
+export const getWebUserId = () => {
+  if (typeof window === 'undefined') return 'webapp_user';
+  let userId = localStorage.getItem('medbayUserId');
+  if (!userId) {
+    userId = `web_${crypto.randomUUID()}`;
+    localStorage.setItem('medbayUserId', userId);
+  }
+  return userId;
+};
+
 export const sendMessageToBot = async (messagePayload) => {
   try {
     const response = await apiClient.post('/webhook/web', messagePayload);
@@ -30,6 +43,19 @@ export const getAddressFromCoords = async (latitude, longitude) => {
   }
 };
 
+// --- DASHBOARD STATS API FUNCTION ---
+// One request for the whole dashboard: { records, yearly, years, countries, ... },
+// precomputed by the backend. Pass a country for its trend series instead.
+export const getDashboardStats = async (country = null) => {
+  try {
+    const response = await apiClient.get('/api/health-stats', { params: country ? { country } : undefined });
+    return response.data;
+  } catch (error) {
+    console.error('Error fetching dashboard stats:', error);
+    throw error;
+  }
+};
+
 // --- X-RAY UPLOAD API FUNCTION ---
 export const uploadXrayImage = async (file) => {
   try {